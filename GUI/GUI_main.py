@@ -87,16 +87,23 @@ class Photometry_GUI(QtGui.QWidget):
         self.rate_label = QtGui.QLabel('Sampling rate (Hz):')
         self.rate_text = QtGui.QLineEdit()
         self.rate_text.setFixedWidth(40)
+        self.oversampling_label = QtGui.QLabel('Oversampling:')
+        self.oversampling_select = QtGui.QComboBox()
+        self.oversampling_select.addItems(['8', '16', '32', '64'])
+        set_cbox_item(self.oversampling_select, str(config.default_oversampling))
 
         self.settingsgroup_layout = QtGui.QHBoxLayout()
         self.settingsgroup_layout.addWidget(self.mode_label)
         self.settingsgroup_layout.addWidget(self.mode_select)
         self.settingsgroup_layout.addWidget(self.rate_label)
         self.settingsgroup_layout.addWidget(self.rate_text)
+        self.settingsgroup_layout.addWidget(self.oversampling_label)
+        self.settingsgroup_layout.addWidget(self.oversampling_select)
         self.settings_groupbox.setLayout(self.settingsgroup_layout)
 
         self.mode_select.activated[str].connect(self.select_mode)
         self.rate_text.textChanged.connect(self.rate_text_change)
+        self.oversampling_select.activated[str].connect(self.select_oversampling)
 
         # Current groupbox
 
@@ -175,6 +182,16 @@ class Photometry_GUI(QtGui.QWidget):
         self.record_button.clicked.connect(self.record)
         self.stop_button.clicked.connect(self.stop)
 
+        # Acquisition health groupbox
+
+        self.metrics_groupbox = QtGui.QGroupBox('Acquisition health')
+
+        self.metrics_text = QtGui.QLabel('Not running')
+
+        self.metricsgroup_layout = QtGui.QHBoxLayout()
+        self.metricsgroup_layout.addWidget(self.metrics_text)
+        self.metrics_groupbox.setLayout(self.metricsgroup_layout)
+
         # Plots
 
         self.analog_plot  = Analog_plot(self)
@@ -196,6 +213,8 @@ class Photometry_GUI(QtGui.QWidget):
         self.horizontal_layout_1.addWidget(self.current_groupbox)
         self.horizontal_layout_2.addWidget(self.file_groupbox)
         self.horizontal_layout_2.addWidget(self.acquisition_groupbox)
+        self.horizontal_layout_3 = QtGui.QHBoxLayout()
+        self.horizontal_layout_3.addWidget(self.metrics_groupbox)
         self.plot_splitter.addWidget(self.analog_plot)
         self.plot_splitter.addWidget(self.digital_plot.axis)
         self.plot_splitter.addWidget(self.event_triggered_plot.axis)
@@ -203,6 +222,7 @@ class Photometry_GUI(QtGui.QWidget):
 
         self.vertical_layout.addLayout(self.horizontal_layout_1)
         self.vertical_layout.addLayout(self.horizontal_layout_2)
+        self.vertical_layout.addLayout(self.horizontal_layout_3)
         self.vertical_layout.addWidget(self.plot_splitter)
 
         self.setLayout(self.vertical_layout)
@@ -211,8 +231,12 @@ class Photometry_GUI(QtGui.QWidget):
 
         self.update_timer = QtCore.QTimer() # Timer to regularly call process_data()
         self.update_timer.timeout.connect(self.process_data)
+        self.render_timer = QtCore.QTimer() # Timer to regularly call render() when running.
+        self.render_timer.timeout.connect(self.render)
         self.refresh_timer = QtCore.QTimer() # Timer to regularly call refresh() when not running.
         self.refresh_timer.timeout.connect(self.refresh)
+        self.metrics_timer = QtCore.QTimer() # Timer to regularly call update_metrics() when running.
+        self.metrics_timer.timeout.connect(self.update_metrics)
 
         # Initial setup.
 
@@ -225,6 +249,7 @@ class Photometry_GUI(QtGui.QWidget):
     def connect(self):
         try:
             self.board = Acquisition_board(self.port_select.currentText())
+            self.board.set_oversampling(int(self.oversampling_select.currentText()))
             self.select_mode(self.mode_select.currentText())
             self.port_select.setEnabled(False)
             self.settings_groupbox.setEnabled(True)
@@ -287,6 +312,10 @@ class Photometry_GUI(QtGui.QWidget):
             self.analog_plot.amblightcor_checkbox.setChecked(False)
             self.analog_plot.amblightcor_checkbox.setEnabled(False)
 
+    def select_oversampling(self, oversampling):
+        self.board.set_oversampling(int(oversampling))
+        self.rate_text.setText(str(self.board.sampling_rate))
+
     def rate_text_change(self, text):
         if text:
             try:
@@ -305,11 +334,14 @@ class Photometry_GUI(QtGui.QWidget):
         # Reset plots.
         self.analog_plot.reset(self.board.sampling_rate)
         self.digital_plot.reset(self.board.sampling_rate)
-        self.event_triggered_plot.reset(self.board.sampling_rate)
+        self.event_triggered_plot.reset(self.board.sampling_rate, self.analog_plot)
         # Start acquisition.
         self.board.start()
         self.refresh_timer.stop()
         self.update_timer.start(config.update_interval)
+        self.render_timer.start(config.render_interval)
+        self.metrics_timer.start(self.refresh_interval)
+        self.new_data = False # Whether data has been received since plots were last rendered.
         self.running = True
         # Update UI.
         self.board_groupbox.setEnabled(False)
@@ -341,6 +373,9 @@ class Photometry_GUI(QtGui.QWidget):
     def stop(self):
         self.board.stop()
         self.update_timer.stop()
+        self.render_timer.stop()
+        self.metrics_timer.stop()
+        self.update_metrics()
         self.refresh_timer.start(self.refresh_interval)
         self.running = False
         self.stop_button.setEnabled(False)
@@ -361,6 +396,8 @@ class Photometry_GUI(QtGui.QWidget):
     def serial_connection_lost(self):
         if self.running:
             self.update_timer.stop()
+            self.render_timer.stop()
+            self.metrics_timer.stop()
             self.refresh_timer.start(self.refresh_interval)
             self.running = False
             self.board_groupbox.setEnabled(True)
@@ -374,25 +411,53 @@ class Photometry_GUI(QtGui.QWidget):
 
     def process_data(self):
         # Called regularly while running, read data from the serial port
-        # and update the plot.
+        # and update the signal histories and event triggered averages.
         data = self.board.process_data()
         if data:
+            self.new_data = True
             if self.mode in ('1site-4colors', '2sites-4colors'):
                 new_ADC1_green_ca, new_ADC1_green_iso, new_ADC2_red_ca, new_ADC2_red_iso, new_DI1, new_DI2 = data
                 self.analog_plot.update(new_ADC1_green_ca, new_ADC1_green_iso, new_ADC2_red_ca, new_ADC2_red_iso)
                 self.digital_plot.update(new_DI1, new_DI2)
-                self.event_triggered_plot.update(new_DI1, self.digital_plot, self.analog_plot, self.mode)
+                self.event_triggered_plot.update(len(new_DI1), self.digital_plot, self.analog_plot)
             elif self.mode in ('1site-3colors', '2sites-3colors'):
                 new_ADC1_green_ca, new_ADC1_green_iso, new_ADC2_red_ca, new_DI1, new_DI2 = data
                 self.analog_plot.update(new_ADC1_green_ca, new_ADC1_green_iso, new_ADC2_red_ca, None)
                 self.digital_plot.update(new_DI1, new_DI2)
-                self.event_triggered_plot.update(new_DI1, self.digital_plot, self.analog_plot, self.mode)
+                self.event_triggered_plot.update(len(new_DI1), self.digital_plot, self.analog_plot)
             else:
                 new_ADC1, new_ADC2, new_DI1, new_DI2 = data
                 self.analog_plot.update(new_ADC1, new_ADC2, None, None)
                 self.digital_plot.update(new_DI1, new_DI2)
-                self.event_triggered_plot.update(new_DI1, self.digital_plot, self.analog_plot, self.mode)
-            self.record_clock.update()
+                self.event_triggered_plot.update(len(new_DI1), self.digital_plot, self.analog_plot)
+
+    def render(self):
+        # Called regularly while running, redraw plots if new data has been received,
+        # skipping plots which are not visible, e.g. collapsed in the splitter, and all
+        # plots if the window is minimised.
+        if not self.new_data or self.isMinimized() or not self.isVisible():
+            return
+        self.new_data = False
+        for plot, widget in ((self.analog_plot, self.analog_plot),
+                             (self.digital_plot, self.digital_plot.axis),
+                             (self.event_triggered_plot, self.event_triggered_plot.axis)):
+            if not widget.visibleRegion().isEmpty():
+                plot.render()
+        self.record_clock.update()
+
+    def update_metrics(self):
+        # Called regularly while running, show acquisition health metrics.
+        m = self.board.get_metrics()
+        n_errors = (m['bad_checksums'] + m['bad_end_bytes'] + m['skipped_chunks'] +
+                    m['board_overruns'] + m['ring_dropped_samples'])
+        self.metrics_text.setText(
+            'Errors: checksum {bad_checksums}, end bytes {bad_end_bytes}, skipped chunks {skipped_chunks}, '
+            'board overruns {board_overruns}, '
+            'dropped samples {ring_dropped_samples}   |   {kbps:.1f} kB/s   |   jitter {jitter:.1f} ms   |   '
+            'backlog {in_waiting} B   |   latency {latency:.0f} ms   |   write {write:.1f} ms, queue {writer_queue_depth}'
+            .format(kbps=m['bytes_per_second']/1000, jitter=m['chunk_jitter']*1000,
+                    latency=m['ingest_latency']*1000, write=m['write_latency']*1000, **m))
+        self.metrics_text.setStyleSheet('color: rgb(255, 0, 0);' if n_errors else '')
 
     def refresh(self):
         # Called regularly while not running, scan serial ports for 
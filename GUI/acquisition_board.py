@@ -6,33 +6,68 @@ import os
 import numpy as np
 import json
 import time
+import threading
 from inspect import getsource
 from datetime import datetime
 from time import sleep
 
 from GUI.pyboard import Pyboard, PyboardError
-from GUI.config import VERSION
+from GUI.data_writer import Data_writer, encode_csv
+from GUI.config import VERSION, sample_ring_dur, metrics_log_interval, transfer_block_size, transfer_window, \
+                       protocol_version, firmware_n_buffers, default_oversampling
+
+# Maximum sampling rate for each mode with 64x oversampling (Hz), see max_sampling_rate.
+max_rates = {'2 colour continuous': 1000, # 2 channel GFP/RFP acquisition mode.
+             '1 colour time div.' : 130,  # GFP and isosbestic using time division multiplexing.
+             '2 colour time div.' : 130,
+             '1site-4colors'      : 65,   # GFP, RFP and respective isosbestic using time division multiplexing. (130*2/4)
+             '2sites-4colors'     : 65,
+             '1site-3colors'      : 90,   # GFP, RFP and green isosbestic using time division multiplexing. (130*2/3)
+             '2sites-3colors'     : 90}
+
+max_skip = 256 # Largest number of missing chunks accepted as genuine rather than misalignment.
 
 class Acquisition_board(Pyboard):
     '''Class for aquiring data from a micropython photometry system on a host computer.'''
 
-    def __init__(self, port):
+    def __init__(self, port, data_writer=None):
         '''Open connection to pyboard and instantiate Photometry class on pyboard with
-        provided parameters.'''
-        self.data_file = None
+        provided parameters.  Data files are written by data_writer if provided, otherwise
+        the board creates its own Data_writer.'''
+        self.data_file = None # Path of file being recorded to.
         self.running = False
         self.LED_current = [0,0]
         self.file_type = None
+        self.mode = None
+        self.oversampling = default_oversampling
         super().__init__(port, baudrate=115200)
-        self.enter_raw_repl() # Reset pyboard.
-        # Transfer firmware if not already on board.
-        self.exec(getsource(_djb2_file))     # Define djb2 hashing function on board.
-        self.exec(getsource(_receive_file))  # Define receive file function on board.
-        self.transfer_file(os.path.join('uPy', 'photometry_upy.py'))
-        # Import firmware and instantiate photometry class.
-        self.exec('import photometry_upy')
-        self.exec('p = photometry_upy.Photometry()')
-        self.volts_per_division = eval(self.eval('p.volts_per_division').decode())
+        self.enter_raw_repl(soft_reset=False) # Interrupt any running program.
+        # Check whether current firmware is already imported on board from a previous
+        # connection, in which case the board does not need to be reset.
+        firmware_path = os.path.join('uPy', 'photometry_upy.py')
+        firmware_hash = _cached_djb2_file(firmware_path)
+        board_firmware_hash, firmware_imported, helpers_defined = eval(self.eval(
+            "(globals().get('_firmware_hash'), 'photometry_upy' in globals(), '_file_block_hashes' in globals())").decode())
+        if board_firmware_hash == firmware_hash:
+            self.exec('p.stop()\np = photometry_upy.Photometry()')
+        else:
+            if firmware_imported: # Reset pyboard to clear old firmware.
+                self.soft_reset()
+                helpers_defined = False
+            # Transfer firmware if not already on board.
+            if not helpers_defined:
+                self.exec(getsource(_djb2_file) + getsource(_file_block_hashes) + getsource(_receive_file)) # Define file transfer functions on board.
+            self.transfer_file(firmware_path)
+            # Import firmware and instantiate photometry class.
+            self.exec('import photometry_upy\np = photometry_upy.Photometry()\n'
+                      '_firmware_hash = {}'.format(firmware_hash))
+        self.volts_per_division, board_protocol_versions = eval(self.eval(
+            "(p.volts_per_division, getattr(p, 'protocol_versions', (1,)))").decode())
+        # Serial data format, see photometry_upy._send_buffer and _send_buffer_v2.
+        self.protocol = protocol_version if protocol_version in board_protocol_versions else 1
+        # Setup thread which writes data files to disk.
+        self.own_data_writer = data_writer is None
+        self.data_writer = Data_writer() if self.own_data_writer else data_writer
  
     # -----------------------------------------------------------------------
     # Data acquisition.
@@ -43,16 +78,18 @@ class Acquisition_board(Pyboard):
         assert mode in ['2 colour continuous', '1 colour time div.', '2 colour time div.', '1site-3colors', '1site-4colors', '2sites-3colors', '2sites-4colors'], \
             "Invalid mode, value values: '2 colour continuous', '1 colour time div.', '2 colour time div.', '1site-3colors', '1site-4colors', '2sites-3colors', or '2sites-4colors'."
         self.mode = mode
-        if mode == '2 colour continuous':   # 2 channel GFP/RFP acquisition mode.
-            self.max_rate = 1000  # Maximum sampling rate allowed for this mode.
-        elif mode in ('1 colour time div.', '2 colour time div.'): # GFP and isosbestic using time division multiplexing.
-            self.max_rate = 130   # Hz.
-        elif mode in ('1site-4colors', '2sites-4colors'): # GFP, RFP and respective isosbestic using time division multiplexing.
-            self.max_rate = 65    # Hz. (130*2/4)
-        elif mode in ('1site-3colors', '2sites-3colors'): # GFP, RFP and green isosbestic using time division multiplexing.
-            self.max_rate = 90    # Hz. (130*2/3)
+        self.max_rate = max_sampling_rate(mode, self.oversampling) # Maximum sampling rate allowed for this mode.
         self.set_sampling_rate(self.max_rate)
         self.exec("p.set_mode('{}')".format(mode))
+
+    def set_oversampling(self, oversampling):
+        '''Set the number of ADC reads averaged per sample, valid values 8, 16, 32, 64.
+        Lower oversampling allows higher sampling rates at the cost of more noise.  If
+        the mode is set, the sampling rate is set to the new maximum rate.'''
+        assert oversampling in (8, 16, 32, 64), 'Invalid oversampling, valid values: 8, 16, 32, 64.'
+        self.oversampling = oversampling
+        if self.mode:
+            self.set_mode(self.mode)
         
     def set_ambientlightcorrection(self, ambientlightcorrection):
         self.exec("p.set_ambientlightcorrection({})".format(ambientlightcorrection))
@@ -79,22 +116,42 @@ class Acquisition_board(Pyboard):
         else:
             sr = self.sampling_rate
         self.buffer_size = max(2, int(sr // 40) * 2)
-        self.serial_chunk_size = (self.buffer_size+3)*2
+        self.serial_chunk_size = (self.buffer_size+4)*2
         return self.sampling_rate
 
     def start(self):
         '''Start data acquistion and streaming on the pyboard.'''
         if self.mode in ('1site-4colors', '2sites-4colors'):
             sampratetosend = self.sampling_rate * 4 / 2
+            period = 4
         elif self.mode in ('1site-3colors', '2sites-3colors'):
             sampratetosend = self.sampling_rate * 3 / 2
+            period = 3
         else:
             sampratetosend = self.sampling_rate
-        self.exec_raw_no_follow('p.start({},{})'.format(sampratetosend, self.buffer_size))
+            period = 2
+        self.exec_raw_no_follow('p.start({},{},{},{},{})'.format(
+            sampratetosend, self.buffer_size, self.protocol, firmware_n_buffers, self.oversampling))
         self.chunk_number = 0 # Number of data chunks received from board, modulo 2**16.
         self.running = True
-        self.buffersignal = []
-        self.bufferdigital = []
+        # Start thread which reads data from serial port into sample ring.
+        self.sample_ring = Sample_ring(int(2*sampratetosend*sample_ring_dur), align=period)
+        # Preallocate buffers used by process_data, the first n_carry samples of raw_buffer 
+        # are samples of an incomplete time division cycle carried over from the last call.
+        self.period = period # Period of time multiplexing (samples).
+        self.n_carry = 0
+        self.raw_buffer     = np.zeros(self.sample_ring.capacity+period, dtype=np.dtype('<u2'))
+        self.signal_buffer  = np.zeros(self.sample_ring.capacity+period, dtype=np.dtype('<u2'))
+        self.digital_buffer = np.zeros(self.sample_ring.capacity+period, dtype=np.uint8)
+        self.serial_buffer = b'' # Bytes of partially received chunk.
+        self.resyncing = False # True while searching for a chunk boundary.
+        self.confirming_jump = False # True while waiting for the chunk after a jump in chunk numbers.
+        self.resync_skipped_bytes = 0
+        self.chunk_interval = self.buffer_size/(2*sampratetosend) # Interval between chunks sent by board (seconds).
+        self.reset_metrics()
+        self.serial.timeout = 0.1 # Allows serial reader thread to check for stop event.
+        self.serial_reader = Serial_reader(self)
+        self.serial_reader.start()
 
     def record(self, data_dir, subject_ID, file_type='ppd'):
         '''Open data file and write data header.'''
@@ -107,120 +164,419 @@ class Acquisition_board(Pyboard):
                        'date_time' : date_time.isoformat(timespec='seconds'),
                        'mode': self.mode,
                        'sampling_rate': self.sampling_rate,
+                       'oversampling': self.oversampling,
                        'volts_per_division': self.volts_per_division,
                        'LED_current': self.LED_current,
                        'version': VERSION}
+        self.data_writer.open(file_path)
+        self.data_file = file_path
+        self.metrics_file = file_path[:-4] + '_metrics.jsonl'
+        self.data_writer.open(self.metrics_file)
+        self.last_metrics_log = time.time()
         if file_type == 'ppd': # Single binary .ppd file.
-            self.data_file = open(file_path, 'wb')
             data_header = json.dumps(header_dict).encode()
-            self.data_file.write(len(data_header).to_bytes(2, 'little'))
-            self.data_file.write(data_header)
+            self.data_writer.write(file_path, len(data_header).to_bytes(2, 'little') + data_header)
         elif file_type == 'csv': # Header in .json file and data in .csv file.
             with open(os.path.join(data_dir, file_name[:-4] + '.json'), 'w') as headerfile:
                 headerfile.write(json.dumps(header_dict, sort_keys=True, indent=4))
-            self.data_file = open(file_path, 'w')
             if self.mode in ('1site-4colors', '2sites-4colors'):
-                self.data_file.write('Analog1_ca, Analog1_iso, Analog2_ca, Analog_iso, Digital1, Digital2\n')
+                column_names = 'Analog1_ca, Analog1_iso, Analog2_ca, Analog_iso, Digital1, Digital2'
             elif self.mode in ('1site-3colors', '2sites-3colors'):
-                self.data_file.write('Analog1_ca, Analog1_iso, Analog2_ca, Digital1, Digital2\n')
+                column_names = 'Analog1_ca, Analog1_iso, Analog2_ca, Digital1, Digital2'
             else:
-                self.data_file.write('Analog1, Analog2, Digital1, Digital2\n')
+                column_names = 'Analog1, Analog2, Digital1, Digital2'
+            self.data_writer.write(file_path, (column_names + os.linesep).encode())
         return file_name
 
     def stop_recording(self):
+        '''Close data file once all queued data has been written.'''
         if self.data_file:
-            self.data_file.close()
-        self.data_file = None
-        self.buffersignal = []
-        self.bufferdigital = []
+            try:
+                self.log_metrics()
+            finally:
+                try:
+                    self.data_writer.close(self.data_file)
+                finally:
+                    self.data_writer.close(self.metrics_file)
+                    self.data_file = None
 
     def stop(self):
         if self.data_file:
             self.stop_recording()
         self.serial.write(b'\xFF') # Stop signal
         sleep(0.1)
+        self.serial_reader.stop()
+        self.serial.timeout = None
         self.serial.reset_input_buffer()
         self.running = False
-        self.buffersignal = []
-        self.bufferdigital = []
+
+    def close(self):
+        if self.own_data_writer:
+            self.data_writer.stop()
+        super().close()
+
+    def read_serial(self):
+        '''Read all complete chunks of data waiting on the serial line, check data 
+        integrity and put data samples into the sample ring.  Chunks are checked together
+        as rows of a 2D array.  Called repeatedly by the serial reader thread while 
+        acquisition is running.'''
+        if self.protocol == 2:
+            return self.read_serial_v2()
+        # Resynchronising, or confirming a jump in chunk numbers, needs the following chunk.
+        min_chunks = 2 if (self.resyncing or self.confirming_jump) else 1
+        in_waiting = self.serial.in_waiting
+        n_chunks = max(min_chunks, (len(self.serial_buffer) + in_waiting) // self.serial_chunk_size)
+        new_bytes = self.serial.read(max(0, n_chunks*self.serial_chunk_size - len(self.serial_buffer)))
+        self.serial_buffer += new_bytes
+        self.update_serial_metrics(len(new_bytes), in_waiting)
+        if len(self.serial_buffer) < min_chunks*self.serial_chunk_size:
+            return # Serial read timed out before full chunk received.
+        if self.resyncing:
+            self.resynchronise(self.serial_buffer, self.chunk_number, first_offset=0)
+            if self.resyncing:
+                return
+        n_chunks = len(self.serial_buffer) // self.serial_chunk_size
+        self.confirming_jump = False
+        if n_chunks == 0:
+            return
+        buffer = self.serial_buffer
+        chunks = np.frombuffer(buffer, dtype=np.dtype('<u2'),
+                               count=n_chunks*(self.buffer_size+4)).reshape(n_chunks, -1)
+        self.serial_buffer = buffer[n_chunks*self.serial_chunk_size:]
+        data = chunks[:,:-4]
+        checksum_OK  = chunks[:,-2] == chunks[:,:-2].sum(axis=1, dtype=np.dtype('<u2')) # Sum of data, overruns and chunk number modulo 2**16.
+        end_bytes_OK = chunks[:,-1] == 0
+        # A misaligned chunk can still pass the checks, e.g. when signals are zero, so chunks
+        # implying more than max_skip missing chunks are treated as misaligned rather than
+        # padded with zeros.  Chunks skipping forward in the chunk number sequence are only
+        # accepted if the following chunk has the next chunk number.
+        chunk_numbers = chunks[:,-3]
+        prev_numbers = np.empty_like(chunk_numbers)
+        prev_numbers[0]  = self.chunk_number
+        prev_numbers[1:] = chunk_numbers[:-1]
+        n_skipped_chunks = (chunk_numbers - prev_numbers - 1).view(np.int16) # rollover safe subtraction.
+        n_overruns = chunks[:,-4].astype(np.intp) # Chunks lost on board before each chunk.
+        chunk_OK = (checksum_OK & (n_skipped_chunks >= 0) & (n_skipped_chunks <= max_skip)
+                    & (n_overruns <= max_skip))
+        followed = np.zeros(n_chunks, dtype=bool) # Chunk followed by valid chunk with next chunk number.
+        followed[:-1] = chunk_OK[1:] & (n_skipped_chunks[1:] == 0)
+        jump = n_skipped_chunks > 0
+        chunk_OK[:-1] &= ~jump[:-1] | followed[:-1]
+        misaligned = None
+        if not chunk_OK.all():
+            # Chunks read by computer not aligned with those sent by board, keep chunks before
+            # first misaligned chunk and resynchronise to the next chunk boundary.  Bytes after
+            # the misaligned chunk are checked again when resynchronising so are not counted.
+            n_chunks = int(np.argmin(chunk_OK))
+            misaligned = buffer[n_chunks*self.serial_chunk_size:]
+            self.n_bad_checksum  += int(np.sum(~checksum_OK[:n_chunks+1]))
+            self.n_bad_end_bytes += int(np.sum(~end_bytes_OK[:n_chunks+1]))
+            # A valid chunk with implausible chunk number may start a new chunk numbering, 
+            # in which case resynchronising accepts it if followed by the next chunk number.
+            renumbered = (checksum_OK[n_chunks] and n_overruns[n_chunks] <= max_skip and
+                          not 0 <= n_skipped_chunks[n_chunks] <= max_skip)
+        elif jump[-1]: # Keep last chunk until following chunk is received.
+            n_chunks -= 1
+            self.serial_buffer = buffer[n_chunks*self.serial_chunk_size:]
+            self.confirming_jump = True
+        self.n_chunks_received += n_chunks
+        self.update_chunk_jitter(n_chunks)
+        if n_chunks:
+            chunks, data = chunks[:n_chunks], data[:n_chunks]
+            chunk_numbers, n_skipped_chunks, n_overruns = (
+                chunk_numbers[:n_chunks], n_skipped_chunks[:n_chunks], n_overruns[:n_chunks])
+            # Check whether any chunks have been skipped, this can occur following an input buffer
+            # reset, or lost on the board due to overruns of the board's sample buffer ring.
+            self.chunk_number = chunk_numbers[-1]
+            if n_skipped_chunks.any() or n_overruns.any():
+                self.n_skipped_chunks += int(np.sum(n_skipped_chunks))
+                self.n_board_overruns += int(np.sum(n_overruns))
+                n_missing = n_skipped_chunks + n_overruns
+                if n_missing.any(): # Insert zeros in place of missing chunks.
+                    chunk_slots = np.arange(n_chunks) + np.cumsum(n_missing)
+                    padded_data = np.zeros((chunk_slots[-1]+1, self.buffer_size), dtype=np.dtype('<u2'))
+                    padded_data[chunk_slots] = data
+                    data = padded_data
+            self.sample_ring.put(data.reshape(-1))
+        if misaligned is not None:
+            self.resynchronise(misaligned, self.chunk_number, first_offset=0 if renumbered else 1)
+
+    def read_serial_v2(self):
+        '''Read all complete chunks waiting on the serial line in protocol 2 format (see
+        photometry_upy._send_buffer_v2), check data integrity, decode them and put the data
+        samples into the sample ring.  Chunks failing checks are skipped by searching for
+        the next byte offset where a valid chunk starts.  As for protocol 1, chunks implying
+        more than max_skip missing chunks are only accepted if followed by a chunk with the
+        next chunk number, in which case missing chunks are not padded with zeros.'''
+        in_waiting = self.serial.in_waiting
+        new_bytes = self.serial.read(max(1, in_waiting))
+        self.serial_buffer += new_bytes
+        self.update_serial_metrics(len(new_bytes), in_waiting)
+        buffer = self.serial_buffer
+        samples = []
+        n_chunks = self.n_chunks_received
+        i = 0 # Byte offset of current chunk in buffer.
+        while True:
+            frame = self.parse_frame_v2(buffer, i)
+            if frame is None:
+                break # Wait for rest of chunk.
+            if frame:
+                frame_size, chunk_number, n_overruns, data = frame
+                n_skipped_chunks = ((chunk_number - int(self.chunk_number) - 1 + 0x8000) & 0xffff) - 0x8000 # Rollover safe subtraction.
+                if not (0 <= n_skipped_chunks <= max_skip and n_overruns <= max_skip):
+                    next_frame = self.parse_frame_v2(buffer, i+frame_size)
+                    if next_frame is None:
+                        break # Wait for next chunk.
+                    if next_frame and next_frame[1] == (chunk_number + 1) & 0xffff:
+                        n_skipped_chunks = n_overruns = 0 # Numbers of missing chunks not known.
+                        self.n_resyncs += 1
+                    else:
+                        frame = False
+            if not frame: # Search for start of next valid chunk one byte at a time.
+                if not self.resyncing:
+                    self.resyncing = True
+                    self.n_resyncs += 1
+                self.n_resync_bytes += 1
+                i += 1
+                continue
+            self.resyncing = False
+            self.n_chunks_received += 1
+            self.chunk_number = chunk_number
+            self.n_skipped_chunks += n_skipped_chunks
+            self.n_board_overruns += n_overruns
+            n_missing = n_skipped_chunks + n_overruns
+            if n_missing: # Insert zeros in place of missing chunks.
+                samples.append(np.zeros(n_missing*self.buffer_size, dtype=np.dtype('<u2')))
+            samples.append(data)
+            i += frame_size
+        self.serial_buffer = buffer[i:]
+        self.update_chunk_jitter(self.n_chunks_received - n_chunks)
+        if samples:
+            self.sample_ring.put(np.concatenate(samples))
+
+    def parse_frame_v2(self, buffer, i):
+        '''Check and decode the protocol 2 chunk starting at byte offset i of buffer.
+        Returns (chunk size in bytes, chunk number, overruns, samples) if the chunk is
+        valid, False if not, or None if the chunk has not been completely received.'''
+        if len(buffer) - i < 10:
+            return None
+        max_payload = 6*self.buffer_size + 3*self.period # Largest valid payload (bytes).
+        n_payload = buffer[i] | (buffer[i+1] << 8)
+        if n_payload > max_payload:
+            return False
+        frame_size = (n_payload + 13) & ~3 # Chunks are padded to a multiple of 4 bytes.
+        if len(buffer) - i < frame_size:
+            return None
+        frame = np.frombuffer(buffer, dtype=np.uint8, count=n_payload+6, offset=i)
+        checksum = buffer[i+n_payload+6] | (buffer[i+n_payload+7] << 8)
+        checksum_OK  = checksum == int(frame.sum()) & 0xffff # Sum of header and payload bytes.
+        end_bytes_OK = not any(buffer[i+n_payload+8:i+frame_size]) # End bytes and padding are zero.
+        if not (checksum_OK and end_bytes_OK):
+            if not self.resyncing:
+                self.n_bad_checksum  += not checksum_OK
+                self.n_bad_end_bytes += not end_bytes_OK
+            return False
+        data = decode_chunk_v2(frame[6:], self.buffer_size, self.period)
+        if data is None:
+            return False
+        chunk_number = buffer[i+2] | (buffer[i+3] << 8)
+        n_overruns   = buffer[i+4] | (buffer[i+5] << 8)
+        return frame_size, chunk_number, n_overruns, data
+
+    def resynchronise(self, misaligned, last_chunk_number, first_offset=1):
+        '''Discard bytes from the start of misaligned up to the next chunk boundary.  If
+        no boundary is found, keep the bytes which could still start a chunk and stay in 
+        the resynchronising state until more data has been received.  If the boundary was
+        accepted because the chunk after it has the next chunk number, chunk numbering
+        continues from that chunk without counting skipped chunks.'''
+        n_skip, found, chunk_number = self.find_chunk_start(misaligned, last_chunk_number, first_offset)
+        self.serial_buffer = misaligned[n_skip:]
+        self.resync_skipped_bytes += n_skip
+        self.resyncing = not found
+        if found:
+            if chunk_number is not None:
+                self.chunk_number = (chunk_number - 1) & 0xffff
+            self.n_resyncs += 1
+            self.n_resync_bytes += self.resync_skipped_bytes
+            self.resync_skipped_bytes = 0
+
+    def find_chunk_start(self, buffer, last_chunk_number, first_offset=1):
+        '''Find the first chunk boundary in buffer at or after first_offset. Candidate 
+        chunks must have zero end bytes, a correct checksum and either a chunk number at 
+        most max_skip chunks after last_chunk_number or be followed by a valid chunk with
+        the next chunk number.  Returns (offset, found, chunk_number), if no boundary is
+        found offset is that of the first byte which could still start a chunk.
+        chunk_number is that of the chunk at the boundary if it was accepted because it was
+        followed by the next chunk number, otherwise None.'''
+        n_bytes = len(buffer)
+        bytes_ = np.frombuffer(buffer, dtype=np.uint8)
+        offsets = np.arange(first_offset, n_bytes-self.serial_chunk_size+1)
+        offsets = offsets[(bytes_[offsets+self.serial_chunk_size-2] == 0) &
+                          (bytes_[offsets+self.serial_chunk_size-1] == 0)]
+        checksum_OK   = np.zeros(len(offsets), dtype=bool)
+        chunk_numbers = np.zeros(len(offsets), dtype=np.dtype('<u2'))
+        for parity in (0, 1): # Words at odd and even byte offsets.
+            words = np.frombuffer(buffer, dtype=np.dtype('<u2'), offset=parity,
+                                  count=(n_bytes-parity)//2)
+            word_sums = np.zeros(len(words)+1, dtype=np.dtype('<u2'))
+            np.cumsum(words, dtype=np.dtype('<u2'), out=word_sums[1:]) # Cumulative sum modulo 2**16.
+            mask = offsets % 2 == parity
+            i = offsets[mask] // 2 # Index of first word of candidate chunks.
+            checksum_OK[mask] = (word_sums[i+self.buffer_size+2] - word_sums[i]) == words[i+self.buffer_size+2]
+            chunk_numbers[mask] = words[i+self.buffer_size+1]
+        offsets, chunk_numbers = offsets[checksum_OK], chunk_numbers[checksum_OK]
+        n_skipped_chunks = (chunk_numbers - np.uint16(last_chunk_number) - 1).view(np.int16)
+        plausible = (n_skipped_chunks >= 0) & (n_skipped_chunks <= max_skip)
+        if plausible.any():
+            return int(offsets[np.argmax(plausible)]), True, None
+        # Accept candidate followed by a valid chunk with the next chunk number.
+        j = np.minimum(np.searchsorted(offsets, offsets+self.serial_chunk_size), len(offsets)-1)
+        followed = (offsets[j] == offsets+self.serial_chunk_size) & (chunk_numbers[j] == chunk_numbers+1)
+        if followed.any():
+            k = np.argmax(followed)
+            return int(offsets[k]), True, int(chunk_numbers[k])
+        pending = offsets + 2*self.serial_chunk_size > n_bytes # Following chunk not yet received.
+        if pending.any():
+            return int(offsets[np.argmax(pending)]), False, None
+        return int(max(first_offset, n_bytes-self.serial_chunk_size+1)), False, None
 
     def process_data(self):
-        '''Read a chunk of data from the serial line, check data integrity, extract signals,
-        save signals to disk if file is open, return signals.'''
-        if self.serial.in_waiting > (self.serial_chunk_size):
-            chunk = np.frombuffer(self.serial.read(self.serial_chunk_size), dtype=np.dtype('<u2'))
-            data = chunk[:-3]
-            checksum_OK  = chunk[-2] == (sum(data) & 0xffff)
-            end_bytes_OK = chunk[-1] == 0
-            if not checksum_OK:
-                print('Bad checksum')
-            if not end_bytes_OK:
-                print('Bad end bytes')
-            if not checksum_OK and not end_bytes_OK:
-                # Chunk read by computer not aligned with that send by board.
-                self.serial.reset_input_buffer()
-            else:
-                # Check whether any chunks have been skipped, this can occur following an input buffer reset.
-                self.chunk_number = (self.chunk_number + 1) & 0xffff
-                n_skipped_chunks = np.int16(chunk[-3] - self.chunk_number) # rollover safe subtraction.
-                if not n_skipped_chunks == 0:
-                    print(f'skipped chunks:{n_skipped_chunks}')
-                if n_skipped_chunks > 0: # Prepend data with zeros to replace skipped chunks.
-                    skip_pad = np.zeros(self.buffer_size*n_skipped_chunks, dtype=np.dtype('<u2'))
-                    data = np.hstack([skip_pad, data])
-                    self.chunk_number = (self.chunk_number + n_skipped_chunks) & 0xffff
-                # Extract signals.
-                signal  = data >> 1        # Analog signal is most significant 15 bits.
-                digital = (data % 2) == 1  # Digital signal is least significant bit.
-                if self.mode in ('1site-4colors', '2sites-4colors', '1site-3colors', '2sites-3colors'):
-                    if self.chunk_number > 1:  # look for data in the buffer
-                        signal  = np.concatenate((self.buffersignal,  signal))
-                        digital = np.concatenate((self.bufferdigital, digital))
-                    if self.mode in ('1site-4colors', '2sites-4colors'):
-                        period = 4 # period for time multiplexing (in number of samples)
-                    elif self.mode in ('1site-3colors', '2sites-3colors'):
-                        period = 3 # period for time multiplexing (in number of samples)
-                    nchunks = int(len(signal) / period) # number of data chunks
-                    lastidx = nchunks*period-1 # last index of each chunk
-                    lim = max([lastidx], default=-2) # last index of the last chunk (-2 is there in case no entire chunk has been received)
-                    completesignal     = signal[0:lim+1]  # data that can already be saved/displayed
-                    self.buffersignal  = signal[lim+1:]   # data to be saved/displayed at the next iteration
-                    completedigital    = digital[0:lim+1] # data that can already be saved/displayed
-                    self.bufferdigital = digital[lim+1:]  # data to be saved/displayed at the next iteration
-                    green_ca  = completesignal[0::period]
-                    red_ca    = completesignal[1::period]
-                    green_iso = completesignal[2::period]
-                    if self.mode in ('1site-4colors', '2sites-4colors'):
-                        red_iso = completesignal[3::period]
-                    DI1 = completedigital[::period]
-                    DI2 = completedigital[1::period]
-                else:
-                    ADC1 = signal[::2]  # Alternating samples are signals 1 and 2.
-                    ADC2 = signal[1::2]
-                    DI1 = digital[::2]
-                    DI2 = digital[1::2]
-                # Write data to disk.
-                if self.data_file:
-                    if self.file_type == 'ppd': # Binary data file.
-                        self.data_file.write(data.tobytes())
-                    else: # CSV data file.
-                        if self.mode in ('1site-4colors', '2sites-4colors'):
-                            np.savetxt(self.data_file, np.array([green_ca,green_iso,red_ca,red_iso,DI1,DI2], dtype=int).T,
-                                       fmt='%d', delimiter=',')
-                        elif self.mode in ('1site-3colors', '2sites-3colors'):
-                            np.savetxt(self.data_file, np.array([green_ca,green_iso,red_ca,DI1,DI2], dtype=int).T,
-                                       fmt='%d', delimiter=',')
-                        else:
-                            np.savetxt(self.data_file, np.array([ADC1,ADC2,DI1,DI2], dtype=int).T,
-                                       fmt='%d', delimiter=',')
-                # Return data for plotting.
+        '''Get data received by the serial reader thread since the last call, extract 
+        signals, save signals to disk if file is open, return signals.  Signals are 
+        strided views into buffers preallocated in start(), which are overwritten by the
+        next call, so no arrays are allocated in the steady state.'''
+        if self.serial_reader.exception: # Raise reader's exception once, after stopping acquisition.
+            exception, self.serial_reader.exception = self.serial_reader.exception, None
+            try:
+                self.stop()
+            except Exception:
+                pass # Report the reader's exception rather than one raised while stopping.
+            finally:
+                self.running = False
+            raise exception
+        data, put_time = self.sample_ring.get(out=self.raw_buffer[self.n_carry:])
+        if len(data) == 0:
+            return
+        self.ingest_latency = time.time() - put_time
+        # Extract signals.
+        n_samples = self.n_carry + len(data)
+        n_complete = n_samples - n_samples % self.period # Samples in complete time division cycles.
+        raw = self.raw_buffer[:n_complete]
+        signal  = np.right_shift(raw, 1, out=self.signal_buffer[:n_complete]) # Analog signal is most significant 15 bits.
+        digital = np.bitwise_and(raw, 1, out=self.digital_buffer[:n_complete]).view(bool) # Digital signal is least significant bit.
+        if self.mode in ('1site-4colors', '2sites-4colors', '1site-3colors', '2sites-3colors'):
+            green_ca  = signal[0::self.period]
+            red_ca    = signal[1::self.period]
+            green_iso = signal[2::self.period]
+            if self.mode in ('1site-4colors', '2sites-4colors'):
+                red_iso = signal[3::self.period]
+            DI1 = digital[::self.period]
+            DI2 = digital[1::self.period]
+        else:
+            ADC1 = signal[::2]  # Alternating samples are signals 1 and 2.
+            ADC2 = signal[1::2]
+            DI1 = digital[::2]
+            DI2 = digital[1::2]
+        # Queue data to be written to disk.
+        if self.data_file:
+            if self.file_type == 'ppd': # Binary data file.
+                self.data_writer.write(self.data_file, data.tobytes())
+            else: # CSV data file.
                 if self.mode in ('1site-4colors', '2sites-4colors'):
-                    return green_ca,green_iso,red_ca,red_iso,DI1,DI2
+                    columns = (green_ca,green_iso,red_ca,red_iso,DI1,DI2)
                 elif self.mode in ('1site-3colors', '2sites-3colors'):
-                    return green_ca,green_iso,red_ca,DI1,DI2
+                    columns = (green_ca,green_iso,red_ca,DI1,DI2)
                 else:
-                    return ADC1, ADC2, DI1, DI2
-                
+                    columns = (ADC1,ADC2,DI1,DI2)
+                self.data_writer.write(self.data_file, encode_csv(columns))
+            if time.time() - self.last_metrics_log >= metrics_log_interval:
+                self.log_metrics()
+        # Carry over samples from incomplete cycle to next call.
+        self.raw_buffer[:n_samples-n_complete] = self.raw_buffer[n_complete:n_samples]
+        self.n_carry = n_samples - n_complete
+        # Return data for plotting.
+        if self.mode in ('1site-4colors', '2sites-4colors'):
+            return green_ca,green_iso,red_ca,red_iso,DI1,DI2
+        elif self.mode in ('1site-3colors', '2sites-3colors'):
+            return green_ca,green_iso,red_ca,DI1,DI2
+        else:
+            return ADC1, ADC2, DI1, DI2
+        
+    # -----------------------------------------------------------------------
+    # Acquisition metrics.
+    # -----------------------------------------------------------------------
+
+    def reset_metrics(self):
+        '''Reset acquisition health counters, called when acquisition starts.'''
+        self.n_chunks_received = 0
+        self.n_bad_checksum    = 0
+        self.n_bad_end_bytes   = 0
+        self.n_skipped_chunks  = 0 # Chunks missing from chunk number sequence.
+        self.n_board_overruns  = 0 # Chunks lost on board due to sample buffer ring overruns.
+        self.n_resyncs         = 0
+        self.n_resync_bytes    = 0 # Bytes discarded while resynchronising.
+        self.n_bytes_received  = 0
+        self.bytes_per_second  = 0 # Exponential moving average over ~1 second.
+        self.chunk_jitter      = 0 # Moving average of deviation of data arrival time from expected (seconds).
+        self.max_chunk_jitter  = 0
+        self.in_waiting        = 0 # Bytes waiting in serial input buffer before last read.
+        self.max_in_waiting    = 0
+        self.ingest_latency    = 0 # Time from data being read to being processed (seconds).
+        self.last_read_time = self.last_chunk_time = time.time()
+
+    def update_serial_metrics(self, n_bytes, in_waiting):
+        '''Update metrics of data arrival, called by read_serial after each read.'''
+        now = time.time()
+        self.in_waiting = in_waiting
+        self.max_in_waiting = max(self.max_in_waiting, in_waiting)
+        if n_bytes == 0:
+            return
+        dt = now - self.last_read_time
+        self.last_read_time = now
+        self.n_bytes_received += n_bytes
+        if dt > 0:
+            self.bytes_per_second += (1 - np.exp(-dt))*(n_bytes/dt - self.bytes_per_second)
+
+    def update_chunk_jitter(self, n_chunks):
+        '''Update jitter of data arrival, called by read_serial and read_serial_v2 with the
+        number of chunks received in each read.  Chunks are counted rather than bytes as
+        protocol 2 chunks vary in size.'''
+        if n_chunks == 0:
+            return
+        now = time.time()
+        # Time since chunks were last received compared with time taken for board to send n_chunks.
+        jitter = abs(now - self.last_chunk_time - n_chunks*self.chunk_interval)
+        self.last_chunk_time = now
+        self.chunk_jitter += 0.05*(jitter - self.chunk_jitter)
+        self.max_chunk_jitter = max(self.max_chunk_jitter, jitter)
+
+    def get_metrics(self):
+        '''Return dictionary with a snapshot of acquisition health metrics.'''
+        return {'time'                : round(time.time(), 3),
+                'chunks_received'     : self.n_chunks_received,
+                'bad_checksums'       : self.n_bad_checksum,
+                'bad_end_bytes'       : self.n_bad_end_bytes,
+                'skipped_chunks'      : self.n_skipped_chunks,
+                'board_overruns'      : self.n_board_overruns,
+                'resyncs'             : self.n_resyncs,
+                'resync_skipped_bytes': self.n_resync_bytes,
+                'ring_dropped_samples': self.sample_ring.n_dropped,
+                'bytes_received'      : self.n_bytes_received,
+                'bytes_per_second'    : round(self.bytes_per_second, 1),
+                'chunk_jitter'        : round(self.chunk_jitter, 6),
+                'max_chunk_jitter'    : round(self.max_chunk_jitter, 6),
+                'in_waiting'          : self.in_waiting,
+                'max_in_waiting'      : self.max_in_waiting,
+                'ingest_latency'      : round(self.ingest_latency, 6),
+                'write_latency'       : round(self.data_writer.write_latency, 6),
+                'max_write_latency'   : round(self.data_writer.max_write_latency, 6),
+                'writer_queue_depth'  : self.data_writer.queue_depth}
+
+    def log_metrics(self):
+        '''Write metrics snapshot as a line of JSON to the metrics file.'''
+        self.data_writer.write(self.metrics_file, (json.dumps(self.get_metrics()) + '\n').encode())
+        self.last_metrics_log = time.time()
+
     # -----------------------------------------------------------------------
     # File transfer
     # -----------------------------------------------------------------------
@@ -233,32 +589,220 @@ class Acquisition_board(Pyboard):
             return -1  
         return file_hash
 
-    def transfer_file(self, file_path):
-        '''Copy file at file_path to pyboard.'''
+    def transfer_file(self, file_path, block_size=transfer_block_size, window=transfer_window):
+        '''Copy file at file_path to pyboard.  The file is sent in blocks of block_size
+        bytes, each with a checksum and acknowledged by the board, with up to window blocks
+        sent ahead of the acknowledgements.  Blocks which fail the checksum are resent.
+        Blocks already on the board, e.g. from an interrupted transfer, are not resent.'''
         target_path = os.path.split(file_path)[-1]
         file_size = os.path.getsize(file_path)
-        file_hash = _djb2_file(file_path)
+        file_hash = _cached_djb2_file(file_path)
+        with open(file_path, 'rb') as f:
+            file_data = f.read()
+        blocks = [file_data[i:i+block_size] for i in range(0, file_size, block_size)]
+        block_hashes = _file_block_hashes(file_path, block_size)[1]
         # Try to load file, return once file hash on board matches that on computer.
         for i in range(10):
             if file_hash == self.get_file_hash(target_path):
                 return
-            self.exec_raw_no_follow("_receive_file('{}',{})"
-                                    .format(target_path, file_size))
-            with open(file_path, 'rb') as f:
-                while True:
-                    chunk = f.read(512)
-                    if not chunk:
-                        break
-                    self.serial.write(chunk)
-                    response_bytes = self.serial.read(2)
-                    if response_bytes != b'OK':
-                        time.sleep(0.01)
-                        self.serial.reset_input_buffer()
-                        raise PyboardError
+            # Only send blocks which differ from those on board.
+            board_size, board_hashes = eval(self.eval("_file_block_hashes('{}',{})"
+                                                      .format(target_path, block_size)).decode())
+            resume = 0 < board_size <= file_size
+            block_indices = [k for k in range(len(blocks)) if not
+                             (resume and k < len(board_hashes) and board_hashes[k] == block_hashes[k])]
+            self.exec_raw_no_follow("_receive_file('{}',{},{})"
+                                    .format(target_path, block_size, resume))
+            serial_timeout = self.serial.timeout
+            self.serial.timeout = 5
+            try:
+                self._send_blocks(blocks, block_indices, window)
                 self.follow(3)
+            except PyboardError:
+                self.follow(10) # Wait for board to finish receiving, then retry.
+            finally:
+                self.serial.timeout = serial_timeout
         # Unable to transfer file.
         raise PyboardError
 
+    def _send_blocks(self, blocks, block_indices, window, max_resends=5):
+        # Send the specified blocks to _receive_file running on the board.  Each block is
+        # preceded by its index and length and followed by a checksum, the board responds
+        # with b'A' or b'N' and the block index to acknowledge or reject each block.
+        to_send = list(block_indices)
+        unacknowledged = set()
+        n_resends = 0
+        while to_send or unacknowledged:
+            while to_send and len(unacknowledged) < window:
+                k = to_send.pop(0)
+                block = blocks[k]
+                self.serial.write(k.to_bytes(2, 'little') + len(block).to_bytes(2, 'little') + block + 
+                                  (sum(block) & 0xFFFF).to_bytes(2, 'little'))
+                unacknowledged.add(k)
+            response = self.serial.read(3)
+            k = int.from_bytes(response[1:], 'little')
+            if len(response) < 3 or response[:1] not in (b'A', b'N') or k not in unacknowledged:
+                raise PyboardError('file transfer failed')
+            unacknowledged.remove(k)
+            if response[:1] == b'N': # Checksum failed, resend block.
+                n_resends += 1
+                if n_resends > max_resends*len(blocks):
+                    raise PyboardError('file transfer failed')
+                to_send.append(k)
+        self.serial.write(b'\xFF\xFF\x00\x00') # End of transfer.
+        if self.serial.read(2) != b'OK':
+            raise PyboardError('file transfer failed')
+
+# ----------------------------------------------------------------------------------------
+#  Serial reader.
+# ----------------------------------------------------------------------------------------
+
+class Serial_reader(threading.Thread):
+    '''Thread which reads data from the serial port while acquisition is running, so that
+    data is taken off the serial line independently of how often the GUI processes it.
+    Exceptions raised while reading are stored and raised once by process_data, which
+    stops acquisition.'''
+
+    def __init__(self, board):
+        super().__init__(daemon=True)
+        self.board = board
+        self.stop_event = threading.Event()
+        self.exception = None
+
+    def run(self):
+        try:
+            while not self.stop_event.is_set():
+                self.board.read_serial()
+        except Exception as e:
+            self.exception = e
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+
+
+class Sample_ring():
+    '''Preallocated ring buffer holding data samples between the serial reader thread
+    and process_data.  If the ring overflows the oldest samples are dropped in multiples
+    of align samples, so that time division multiplexed signals stay in register.'''
+
+    def __init__(self, capacity, align=1):
+        self.align = align
+        self.capacity = align*int(np.ceil(capacity/align))
+        self.buffer = np.zeros(self.capacity, dtype=np.dtype('<u2'))
+        self.n_written = 0 # Total number of samples put into ring.
+        self.n_read    = 0 # Total number of samples taken from ring.
+        self.n_dropped = 0 # Total number of samples dropped due to overflow.
+        self.put_time = None # Time of first put since last get.
+        self.lock = threading.Lock()
+
+    def put(self, data):
+        '''Copy data into ring, overwriting the oldest unread samples if full.'''
+        with self.lock:
+            n_excess = len(data) - self.capacity
+            if n_excess > 0: # Data longer than ring, keep only most recent samples.
+                n_skip = self.align*int(np.ceil(n_excess/self.align))
+                data = data[n_skip:]
+                self.n_written += n_skip
+            n = len(data)
+            i = self.n_written % self.capacity
+            n_1 = min(n, self.capacity - i)
+            self.buffer[i:i+n_1] = data[:n_1]
+            self.buffer[:n-n_1] = data[n_1:]
+            self.n_written += n
+            n_unread = self.n_written - self.n_read
+            if n_unread > self.capacity: # Oldest unread samples overwritten.
+                n_drop = self.align*int(np.ceil((n_unread-self.capacity)/self.align))
+                self.n_read += n_drop
+                self.n_dropped += n_drop
+            if self.put_time is None:
+                self.put_time = time.time()
+
+    def get(self, out=None):
+        '''Return array of all samples put into ring since the last call and the time
+        the oldest of them was put into the ring.  If out is provided the samples are
+        copied into it and a view of out is returned.'''
+        with self.lock:
+            i = self.n_read % self.capacity
+            n = self.n_written - self.n_read
+            n_1 = min(n, self.capacity - i)
+            if out is None:
+                out = np.empty(n, dtype=self.buffer.dtype)
+            out[:n_1] = self.buffer[i:i+n_1]
+            out[n_1:n] = self.buffer[:n-n_1]
+            self.n_read += n
+            put_time, self.put_time = self.put_time, None
+        return out[:n], put_time
+
+# ----------------------------------------------------------------------------------------
+#  Sampling rate limits.
+# ----------------------------------------------------------------------------------------
+
+def max_sampling_rate(mode, oversampling):
+    '''Maximum sampling rate (Hz) for mode with oversampling ADC reads per sample.  The
+    rate for 64x oversampling in max_rates is scaled by the ratio of the durations of the
+    firmware ISR with 64x and the specified oversampling.  The ISR duration is modelled as
+    the time taken by its ADC reads, at the firmware's oversampling rate, plus the LED
+    settling delay in time division modes, plus a fixed overhead for the rest of the ISR.'''
+    ISR_overhead = 50e-6 # Seconds.
+    if mode == '2 colour continuous':
+        ISR_duration = lambda n: 2*n/3e5 + ISR_overhead # Two reads at 300kHz.
+    else:
+        ISR_duration = lambda n: 2*n/256e3 + 300e-6 + ISR_overhead # Baseline and sample reads at 256kHz, 300us LED settling.
+    return int(max_rates[mode]*ISR_duration(64)/ISR_duration(oversampling))
+
+# ----------------------------------------------------------------------------------------
+#  Protocol 2 decoding.
+# ----------------------------------------------------------------------------------------
+
+def decode_varints(buf):
+    '''Decode a uint8 array containing a sequence of varints (7 bits per byte, least 
+    significant first, high bit set on all but the last byte) into an array of values.
+    All varints are decoded at once by summing the shifted 7 bit groups of each varint.'''
+    ends = np.flatnonzero(buf < 128) # Index of last byte of each varint.
+    if len(ends) == 0:
+        return np.zeros(0, dtype=np.uint32)
+    buf = buf[:ends[-1]+1]
+    starts = np.zeros(len(ends), dtype=np.intp)
+    starts[1:] = ends[:-1] + 1
+    varint_index = np.zeros(len(buf), dtype=np.intp)
+    varint_index[starts[1:]] = 1
+    np.cumsum(varint_index, out=varint_index)
+    shifts = 7*(np.arange(len(buf)) - starts[varint_index])
+    return np.add.reduceat((buf & 127).astype(np.uint32) << shifts.astype(np.uint32), starts)
+
+def decode_chunk_v2(payload, buffer_size, period):
+    '''Decode the payload of a protocol 2 chunk (see photometry_upy._send_buffer_v2) into
+    buffer_size samples in protocol 1 format, (analog << 1) | digital.  Returns None if
+    the payload is not a valid chunk.'''
+    if len(payload) == 0 or payload[-1] > 127: # Payload must end with a complete varint.
+        return None
+    values = decode_varints(payload)
+    if len(values) < buffer_size:
+        return None
+    # Analog signal, undo zigzag encoding and differences between time division cycles.
+    z = values[:buffer_size].astype(np.int32)
+    deltas = np.zeros(-(-buffer_size//period)*period, dtype=np.int32)
+    deltas[:buffer_size] = (z >> 1) ^ -(z & 1)
+    analog = np.cumsum(deltas.reshape(-1, period), axis=0).reshape(-1)[:buffer_size]
+    # Digital signal, run length encoded separately for each lane of the time division cycle.
+    digital = np.zeros(buffer_size, dtype=np.int32)
+    j = buffer_size # Index of next value.
+    for lane in range(min(period, buffer_size)):
+        lane_len = len(range(lane, buffer_size, period))
+        if j >= len(values):
+            return None
+        n_changes, first_value = int(values[j]) >> 1, int(values[j]) & 1
+        runs = values[j+1:j+1+n_changes].astype(np.intp)
+        j += 1 + n_changes
+        if len(runs) < n_changes or runs.sum() >= lane_len:
+            return None
+        run_lengths = np.append(runs, lane_len - runs.sum())
+        digital[lane::period] = np.repeat((first_value + np.arange(n_changes+1)) & 1, run_lengths)
+    if j != len(values) or analog.min() < 0 or analog.max() >= 1 << 15:
+        return None
+    return ((analog << 1) | digital).astype(np.dtype('<u2'))
+
 # ----------------------------------------------------------------------------------------
 #  Helper functions.
 # ----------------------------------------------------------------------------------------
@@ -274,21 +818,64 @@ def _djb2_file(file_path):
             h = ((h << 5) + h + int.from_bytes(c,'little')) & 0xFFFFFFFF           
     return h
 
+# Host side hashes of files, {file_path: (modification time, size, hash)}.
+_file_hashes = {}
+
+def _cached_djb2_file(file_path):
+    # djb2 hash of file on host computer, only recomputed if file has changed.
+    stat = os.stat(file_path)
+    mtime, size, file_hash = _file_hashes.get(file_path, (None, None, None))
+    if (mtime, size) != (stat.st_mtime, stat.st_size):
+        file_hash = _djb2_file(file_path)
+        _file_hashes[file_path] = (stat.st_mtime, stat.st_size, file_hash)
+    return file_hash
+
+# djb2 hashes of blocks of a file, used on pyboard and host to find which blocks of a
+# file need to be transferred.
+def _file_block_hashes(file_path, block_size):
+    try:
+        f = open(file_path, 'rb')
+    except OSError: # File does not exist.
+        return 0, []
+    file_size = 0
+    hashes = []
+    with f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            file_size += len(block)
+            h = 5381
+            for i in range(0, len(block), 4):
+                h = ((h << 5) + h + int.from_bytes(block[i:i+4],'little')) & 0xFFFFFFFF
+            hashes.append(h)
+    return file_size, hashes
+
 # Used on pyboard for file transfer.
-def _receive_file(file_path, file_size):
+def _receive_file(file_path, block_size, resume):
     usb = pyb.USB_VCP()
     usb.setinterrupt(-1)
-    buf_size = 512
-    buf = bytearray(buf_size)
+    buf = bytearray(block_size+6) # Block index, length, data, checksum.
     buf_mv = memoryview(buf)
-    bytes_remaining = file_size
     try:
-        with open(file_path, 'wb') as f:
-            while bytes_remaining > 0:
-                bytes_read = usb.recv(buf, timeout=5)
-                usb.write(b'OK')
-                if bytes_read:
-                    bytes_remaining -= bytes_read
-                    f.write(buf_mv[:bytes_read])
+        with open(file_path, 'r+b' if resume else 'wb') as f:
+            while True:
+                if usb.recv(buf_mv[:4], timeout=5000) < 4:
+                    break
+                block_index = buf[0] | (buf[1] << 8)
+                block_len = buf[2] | (buf[3] << 8)
+                if block_index == 0xFFFF: # End of transfer.
+                    usb.write(b'OK')
+                    return
+                if block_len > block_size or usb.recv(buf_mv[4:block_len+6], timeout=5000) < block_len+2:
+                    break
+                if sum(buf_mv[4:block_len+4]) & 0xFFFF == buf[block_len+4] | (buf[block_len+5] << 8):
+                    f.seek(block_index*block_size)
+                    f.write(buf_mv[4:block_len+4])
+                    usb.write(b'A')
+                else:
+                    usb.write(b'N')
+                usb.write(buf_mv[:2])
     except:
-        usb.write(b'ER')
\ No newline at end of file
+        pass
+    usb.write(b'ER')
@@ -0,0 +1,119 @@
+# Code which runs on host computer and acquires data from several pyboards in one process.
+# Copyright (c) Thomas Akam 2018-2020.  Licenced under the GNU General Public License v3.
+
+import threading
+
+from GUI.acquisition_board import Acquisition_board
+from GUI.data_writer import Data_writer
+
+class Board_manager():
+    '''Class for acquiring data from several photometry boards in a single host process.
+    Each board reads its serial port on its own serial reader thread, data files for all
+    boards are written by a shared pool of n_writers Data_writer threads.  Boards are
+    accessed through the boards dictionary {port: Acquisition_board}, methods of the
+    manager apply to all boards.'''
+
+    def __init__(self, ports, n_writers=1):
+        '''Connect to the boards on the specified ports in parallel.  If any board fails
+        to connect, boards already connected are closed and the exception is raised.'''
+        self.data_writers = [Data_writer() for i in range(n_writers)]
+        self.boards = {}
+        self.running = False
+        exceptions = []
+        def connect(port, data_writer):
+            try:
+                self.boards[port] = Acquisition_board(port, data_writer=data_writer)
+            except Exception as e:
+                exceptions.append(e)
+        threads = [threading.Thread(target=connect, args=(port, self.data_writers[i % n_writers]))
+                   for i, port in enumerate(ports)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if exceptions:
+            self.close()
+            raise exceptions[0]
+        self.boards = {port: self.boards[port] for port in ports} # Keep order of ports.
+
+    # -----------------------------------------------------------------------
+    # Board settings.
+    # -----------------------------------------------------------------------
+
+    def set_mode(self, mode):
+        for board in self.boards.values():
+            board.set_mode(mode)
+
+    def set_sampling_rate(self, sampling_rate):
+        return {port: board.set_sampling_rate(sampling_rate)
+                for port, board in self.boards.items()}
+
+    def set_ambientlightcorrection(self, ambientlightcorrection):
+        for board in self.boards.values():
+            board.set_ambientlightcorrection(ambientlightcorrection)
+
+    def set_oversampling(self, oversampling):
+        for board in self.boards.values():
+            board.set_oversampling(oversampling)
+
+    def set_LED_current(self, LED_1_current=None, LED_2_current=None):
+        for board in self.boards.values():
+            board.set_LED_current(LED_1_current, LED_2_current)
+
+    # -----------------------------------------------------------------------
+    # Data acquisition.
+    # -----------------------------------------------------------------------
+
+    def start(self):
+        '''Start acquisition on all boards.  If any board fails to start, boards already
+        started are stopped and the exception is raised.'''
+        self.running = True
+        try:
+            for board in self.boards.values():
+                board.start()
+        except Exception:
+            for board in self.boards.values():
+                if board.running:
+                    try:
+                        board.stop()
+                    except Exception:
+                        pass # Raise the exception from start rather than one from stop.
+            self.running = False
+            raise
+
+    def record(self, data_dir, subject_IDs, file_type='ppd'):
+        '''Open data files on all boards, subject_IDs is a dictionary {port: subject_ID}.
+        Returns dictionary {port: file_name}.'''
+        return {port: board.record(data_dir, subject_IDs[port], file_type)
+                for port, board in self.boards.items()}
+
+    def stop_recording(self):
+        for board in self.boards.values():
+            board.stop_recording()
+
+    def stop(self):
+        '''Stop acquisition on all boards.'''
+        for board in self.boards.values():
+            if board.running:
+                board.stop()
+        self.running = False
+
+    def process_data(self):
+        '''Process new data from all boards, returns dictionary {port: data} for boards
+        with new data, where data is the tuple of signals returned by the board's
+        process_data method.'''
+        new_data = {}
+        for port, board in self.boards.items():
+            data = board.process_data()
+            if data:
+                new_data[port] = data
+        return new_data
+
+    def close(self):
+        '''Stop acquisition, close all boards and stop data writer threads.'''
+        if self.running:
+            self.stop()
+        for board in self.boards.values():
+            board.close()
+        for data_writer in self.data_writers:
+            data_writer.stop()
@@ -6,10 +6,35 @@ VERSION = '0.3' # Version number of pyPhotometry.
 
 history_dur   = 10       # Duration of plotted signal history (seconds)
 triggered_dur = [-3,6.9] # Window duration for event triggered signals (seconds pre, post)
-update_interval = 5      # Interval between calls to update function (ms).
+triggered_input = 1      # Digital input which triggers event triggered averages, 1 or 2.
+triggered_ema_tau = None # Time constant (events) of exponential moving average to plot as event triggered average, None to plot mean.
+dFF_tau = 60             # Time constant of isosbestic fit and baseline for online dF/F (seconds).
+update_interval = 5      # Interval between calls to process data function (ms).
+render_interval = 33     # Interval between redraws of plots (ms).
 
 default_LED_current = [10,10] # Channel [1, 2] (mA).
 
 default_acquisition_mode = '1 colour time div.' # Valid values: '2 colour continuous', '1 colour time div.', '2 colour time div.'
 
-default_filetype = 'csv' # Valid values: 'ppd', 'csv'
\ No newline at end of file
+default_filetype = 'csv' # Valid values: 'ppd', 'csv'
+
+# ----------------------------------------------------------------------------------------
+# Acquisition Config
+# ----------------------------------------------------------------------------------------
+
+sample_ring_dur = 60 # Duration of data buffered between serial reader thread and GUI (seconds).
+
+writer_queue_size     = 1000 # Maximum number of data blocks queued for writing to disk.
+writer_flush_interval = 1    # Interval between flushing data files (seconds).
+writer_fsync_interval = 10   # Interval between syncing data files to disk (seconds), None to disable.
+
+metrics_log_interval = 5 # Interval between writing acquisition metrics to file while recording (seconds).
+
+transfer_block_size = 2048 # Size of blocks files are transferred to pyboard in (bytes).
+transfer_window     = 4    # Number of blocks sent to pyboard ahead of acknowledgements.
+
+protocol_version = 1 # Serial data format, 1: 16 bit samples, 2: compact delta and run length encoded (see photometry_upy._send_buffer_v2).
+
+firmware_n_buffers = 40 # Maximum number of sample buffers in the ring on the pyboard, each holds 25ms of data.
+
+default_oversampling = 64 # Number of ADC reads averaged per sample, valid values: 8, 16, 32, 64.
\ No newline at end of file
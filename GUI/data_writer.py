@@ -0,0 +1,178 @@
+# Code which runs on host computer and writes data files to disk on a background thread.
+# Copyright (c) Thomas Akam 2018-2020.  Licenced under the GNU General Public License v3.
+
+import os
+import time
+import queue
+import threading
+import numpy as np
+
+from GUI.config import writer_queue_size, writer_flush_interval, writer_fsync_interval
+
+class Data_writer(threading.Thread):
+    '''Thread which writes data to files on disk, so that slow disk writes do not stall
+    data acquisition or plotting.  Data is passed to the writer through a bounded queue,
+    write() blocks if the queue is full.  Blocks of data queued for the same file are 
+    joined into a single write.  Open files are flushed every flush_interval seconds and,
+    unless fsync_interval is None, synced to disk every fsync_interval seconds.  A single
+    writer can write to several files.  If writing a file fails, the exception is raised
+    by the next call which accesses that file, other files are unaffected.'''
+
+    def __init__(self, queue_size=writer_queue_size, flush_interval=writer_flush_interval,
+                 fsync_interval=writer_fsync_interval):
+        super().__init__(daemon=True)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.files = {} # {file_path: file}, only accessed by writer thread.
+        self.write_latency = 0     # Duration of most recent write (seconds).
+        self.max_write_latency = 0 # Longest write duration (seconds).
+        self.bytes_written = 0
+        self.exceptions = {} # {file_path: exception} for files where writing failed.
+        self.start()
+
+    @property
+    def queue_depth(self):
+        '''Number of items waiting in the queue.'''
+        return self.queue.qsize()
+
+    def open(self, file_path):
+        '''Open a new file for writing.'''
+        self._put(('open', file_path, None))
+
+    def write(self, file_path, data):
+        '''Queue bytes to be written to file.'''
+        self._put(('write', file_path, data))
+
+    def close(self, file_path):
+        '''Write all queued data to file, close file and return once file is closed.
+        Raises any exception which occurred writing the file.'''
+        if not self.is_alive():
+            raise RuntimeError('Data writer thread is not running, unable to close ' + file_path)
+        closed = threading.Event()
+        self.queue.put(('close', file_path, closed))
+        while not closed.wait(self.flush_interval):
+            if not self.is_alive(): # Writer thread died without processing close.
+                raise RuntimeError('Data writer thread stopped before closing ' + file_path)
+        exception = self.exceptions.pop(file_path, None)
+        if exception:
+            raise exception
+
+    def stop(self):
+        '''Close any open files and stop the writer thread.'''
+        self.queue.put(('stop', None, None))
+        self.join()
+
+    def _put(self, item):
+        file_path = item[1]
+        if file_path in self.exceptions:
+            raise self.exceptions[file_path]
+        self.queue.put(item)
+
+    def run(self):
+        last_flush = last_fsync = time.time()
+        pending = {} # {file_path: [bytes]} data waiting to be written.
+        running = True
+        items = []
+        try:
+            while running:
+                items = []
+                try:
+                    items.append(self.queue.get(timeout=self.flush_interval))
+                    while True: # Take all items currently in queue.
+                        items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    pass
+                for action, file_path, arg in items:
+                    if action == 'write':
+                        pending.setdefault(file_path, []).append(arg)
+                        continue
+                    self._write_pending(pending)
+                    if action == 'open':
+                        self._file_operation(file_path, lambda: self.files.update({file_path: open(file_path, 'wb')}))
+                    elif action == 'close':
+                        if file_path in self.files:
+                            self._file_operation(file_path, self.files.pop(file_path).close)
+                        arg.set()
+                    elif action == 'stop':
+                        for file_path, file in list(self.files.items()):
+                            self._file_operation(file_path, file.close)
+                        self.files = {}
+                        running = False
+                self._write_pending(pending)
+                now = time.time()
+                if now - last_flush >= self.flush_interval:
+                    for file_path, file in list(self.files.items()):
+                        self._file_operation(file_path, file.flush)
+                    last_flush = now
+                if self.fsync_interval is not None and now - last_fsync >= self.fsync_interval:
+                    for file_path, file in list(self.files.items()):
+                        self._file_operation(file_path, lambda: (file.flush(), os.fsync(file.fileno())))
+                    last_fsync = now
+        finally: # Release close calls waiting on files which will not be closed normally.
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for action, file_path, arg in items:
+                if action == 'close' and not arg.is_set():
+                    if file_path in self.files:
+                        self.exceptions.setdefault(file_path, RuntimeError(
+                            'Data writer thread stopped before closing ' + file_path))
+                    arg.set()
+
+    def _file_operation(self, file_path, operation):
+        # Call operation on file, if it fails store the exception and stop writing file.
+        try:
+            operation()
+        except Exception as e:
+            self.exceptions[file_path] = e
+            file = self.files.pop(file_path, None)
+            if file:
+                try:
+                    file.close()
+                except Exception:
+                    pass
+
+    def _write_pending(self, pending):
+        # Write data waiting for each file as a single block.
+        for file_path, blocks in pending.items():
+            if file_path not in self.files: # Open failed or previous write failed.
+                continue
+            t0 = time.time()
+            data = b''.join(blocks)
+            self._file_operation(file_path, lambda: self.files[file_path].write(data))
+            self.write_latency = time.time() - t0
+            self.max_write_latency = max(self.max_write_latency, self.write_latency)
+            self.bytes_written += len(data)
+        pending.clear()
+
+# ----------------------------------------------------------------------------------------
+#  CSV encoding.
+# ----------------------------------------------------------------------------------------
+
+def encode_csv(columns, delimiter=',', newline=os.linesep):
+    '''Encode columns of non-negative integers as CSV text, returning one bytes block
+    with the same content np.savetxt(fmt='%d') would write.  All values are converted 
+    to digits at once by treating the text as a 3D array of characters (rows, columns,
+    characters) and masking out leading zeros and unused separator characters.'''
+    values = np.column_stack(columns).astype(np.uint32)
+    if values.size == 0:
+        return b''
+    n_digits = len(str(int(values.max())))
+    separators = [delimiter.encode()]*(values.shape[1]-1) + [newline.encode()]
+    sep_width = max(len(sep) for sep in separators)
+    # Characters and mask of characters to keep for each value.
+    chars = np.empty(values.shape + (n_digits+sep_width,), dtype=np.uint8)
+    mask  = np.zeros(values.shape + (n_digits+sep_width,), dtype=bool)
+    remainder = values.copy()
+    for k in range(n_digits-1, -1, -1):
+        remainder, digit = np.divmod(remainder, 10)
+        chars[:,:,k] = digit + ord('0')
+        mask[:,:,k] = values >= 10**(n_digits-1-k)
+    mask[:,:,n_digits-1] = True # Always keep last digit so zero is written as '0'.
+    for j, sep in enumerate(separators):
+        chars[:,j,n_digits:n_digits+len(sep)] = np.frombuffer(sep, dtype=np.uint8)
+        mask[:,j,n_digits:n_digits+len(sep)] = True
+    return chars[mask].tobytes()
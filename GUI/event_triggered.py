@@ -0,0 +1,70 @@
+# Code which runs on host computer and computes event triggered averages of signals.
+# Copyright (c) Thomas Akam 2018-2020.  Licenced under the GNU General Public License v3.
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+class Event_triggered_average():
+    '''Averages of a set of signals in a window around rising edges of a trigger signal.
+    window is [pre, post] samples relative to the first sample after the rising edge.
+    update is called with the signal histories each time new samples are added.  Windows
+    around all events whose post-event window has been completed by the new samples are
+    extracted together as rows of strided views of the signal histories, and the mean
+    and standard error of the mean across events are updated exactly by combining the
+    statistics of the new events with those of previous events.  If ema_tau is specified
+    an exponential moving average with time constant ema_tau events is also updated.'''
+
+    def __init__(self, window, n_signals, ema_tau=None):
+        self.window = window
+        self.n_signals = n_signals
+        self.alpha = 1 - np.exp(-1./ema_tau) if ema_tau else None # Learning rate for EMA.
+        self.reset()
+
+    def reset(self):
+        window_length = self.window[1] - self.window[0]
+        self.n_events = 0
+        self.mean = np.zeros((self.n_signals, window_length))
+        self.M2   = np.zeros((self.n_signals, window_length)) # Sum of squared deviations from mean.
+        self.ema  = None
+        self.latest = None # Signals around latest event, shape (n_signals, window_length).
+
+    @property
+    def sem(self):
+        '''Standard error of the mean across events, shape (n_signals, window_length).'''
+        if self.n_events < 2:
+            return np.zeros_like(self.mean)
+        return np.sqrt(self.M2/((self.n_events-1)*self.n_events))
+
+    def update(self, signals, trigger, n_new):
+        '''Update averages with events whose windows have been completed by the latest
+        n_new samples.  signals is a list of signal histories and trigger the history of
+        the trigger signal, all 1D arrays of the same length with the latest sample last.
+        Returns the number of new events.'''
+        pre, post = self.window
+        history_length = len(trigger)
+        # Rising edges at samples which are post samples before the end of the history.
+        first = max(history_length - post - n_new, 0)
+        edges = first + 1 + np.flatnonzero(np.diff(trigger[first:history_length-post+1].astype(np.int8)) == 1)
+        edges = edges[edges + pre >= 0] # Drop events whose pre-event window is not in history.
+        if len(edges) == 0:
+            return 0
+        window_length = post - pre
+        windows = np.stack([sliding_window_view(signal, window_length)[edges + pre]
+                            for signal in signals], axis=1) # Shape (n_events, n_signals, window_length)
+        # Combine mean and sum of squared deviations of new events with previous events.
+        n_batch = len(edges)
+        batch_mean = windows.mean(axis=0)
+        batch_M2 = np.square(windows - batch_mean).sum(axis=0)
+        n_total = self.n_events + n_batch
+        delta = batch_mean - self.mean
+        self.mean += delta*n_batch/n_total
+        self.M2 += batch_M2 + np.square(delta)*self.n_events*n_batch/n_total
+        self.n_events = n_total
+        self.latest = windows[-1]
+        # Update exponential moving average.
+        if self.alpha:
+            if self.ema is None: # First event.
+                self.ema, windows = windows[0].copy(), windows[1:]
+            weights = self.alpha*(1-self.alpha)**np.arange(len(windows)-1, -1, -1)
+            self.ema = (1-self.alpha)**len(windows)*self.ema + np.tensordot(weights, windows, axes=1)
+        return n_batch
@@ -0,0 +1,140 @@
+# Code which runs on host computer and acquires data from pyboards without the GUI, for
+# scripted, remote triggered or unattended recording.  Does not import Qt or pyqtgraph.
+# Copyright (c) Thomas Akam 2018-2020.  Licenced under the GNU General Public License v3.
+#
+# Usage from the repository root, see --help for all options:
+#     python pyPhotometry_headless.py --ports COM3 COM4 --subject-IDs m1 m2 --data-dir data --duration 3600
+# or from Python:
+#     acquisition = Headless_acquisition(['COM3'], mode='1 colour time div.')
+#     acquisition.start(data_dir='data', subject_IDs={'COM3': 'm1'})
+#     acquisition.run(duration=3600)
+#     acquisition.close()
+
+import time
+import signal
+import asyncio
+import argparse
+import threading
+
+from GUI.board_manager import Board_manager
+from GUI.config import default_acquisition_mode, default_LED_current, default_oversampling
+
+class Headless_acquisition():
+    '''Acquires data from the boards on the specified ports, using a Board_manager, with
+    data processed by a blocking loop (run) or an asyncio task (run_async) rather than a
+    GUI timer.  If sampling_rate is None the maximum rate for the mode is used.'''
+
+    def __init__(self, ports, mode=default_acquisition_mode, sampling_rate=None,
+                 LED_current=default_LED_current, oversampling=default_oversampling,
+                 ambient_light_correction=True, n_writers=1):
+        self.manager = Board_manager(ports, n_writers)
+        try:
+            self.manager.set_oversampling(oversampling)
+            self.manager.set_mode(mode)
+            if mode != '2 colour continuous':
+                self.manager.set_ambientlightcorrection(ambient_light_correction)
+            if sampling_rate:
+                self.manager.set_sampling_rate(sampling_rate)
+            self.manager.set_LED_current(*LED_current)
+        except Exception:
+            self.manager.close()
+            raise
+        self.stop_event = threading.Event() # Set to stop run loop, e.g. from a signal handler.
+        self.file_names = {}
+
+    def start(self, data_dir=None, subject_IDs=None, file_type='ppd'):
+        '''Start acquisition, and recording if data_dir is specified, subject_IDs is a
+        dictionary {port: subject_ID}.  Returns dictionary {port: file_name}.'''
+        self.manager.start()
+        if data_dir:
+            self.file_names = self.manager.record(data_dir, subject_IDs, file_type)
+        self.start_time = time.time()
+        return self.file_names
+
+    def process_data(self, data_callback=None):
+        '''Process data received from all boards, data_callback(port, data) is called
+        with the signals from each board with new data.'''
+        for port, data in self.manager.process_data().items():
+            if data_callback:
+                data_callback(port, data)
+
+    def _finished(self, duration):
+        return self.stop_event.is_set() or (duration and time.time() - self.start_time >= duration)
+
+    def run(self, duration=None, interval=0.1, data_callback=None, status_callback=None,
+            status_interval=10):
+        '''Process data every interval seconds until duration seconds after start or
+        until stop_event is set, then stop acquisition.  status_callback(metrics) is
+        called every status_interval seconds with {port: metrics}.'''
+        next_status = time.time() + status_interval
+        try:
+            while not self._finished(duration):
+                self.process_data(data_callback)
+                if status_callback and time.time() >= next_status:
+                    status_callback(self.get_metrics())
+                    next_status += status_interval
+                self.stop_event.wait(interval)
+            self.process_data(data_callback)
+        finally:
+            self.stop()
+
+    async def run_async(self, duration=None, interval=0.1, data_callback=None):
+        '''As run but as a coroutine, so acquisition can run in an asyncio event loop.'''
+        try:
+            while not self._finished(duration):
+                self.process_data(data_callback)
+                await asyncio.sleep(interval)
+            self.process_data(data_callback)
+        finally:
+            self.stop()
+
+    def get_metrics(self):
+        return {port: board.get_metrics() for port, board in self.manager.boards.items()}
+
+    def stop(self):
+        '''Stop acquisition and recording.'''
+        if self.manager.running:
+            self.manager.stop()
+
+    def close(self):
+        self.manager.close()
+
+# Command line interface ----------------------------------------------------------------
+
+def print_status(metrics):
+    for port, m in metrics.items():
+        n_errors = (m['bad_checksums'] + m['bad_end_bytes'] + m['skipped_chunks'] +
+                    m['board_overruns'] + m['ring_dropped_samples'])
+        print('{}: {:.1f} kB/s, {} chunks, {} errors'.format(
+            port, m['bytes_per_second']/1000, m['chunks_received'], n_errors), flush=True)
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Acquire pyPhotometry data without the GUI.')
+    parser.add_argument('--ports', nargs='+', required=True, help='Serial ports of boards.')
+    parser.add_argument('--mode', default=default_acquisition_mode)
+    parser.add_argument('--sampling-rate', type=int, default=None, help='Default: maximum rate for mode.')
+    parser.add_argument('--LED-current', type=int, nargs=2, default=default_LED_current, help='mA')
+    parser.add_argument('--oversampling', type=int, default=default_oversampling, choices=[8, 16, 32, 64])
+    parser.add_argument('--no-ambient-light-correction', action='store_true')
+    parser.add_argument('--data-dir', default=None, help='Directory to record to, default: do not record.')
+    parser.add_argument('--subject-IDs', nargs='+', default=None, help='Subject ID for each port.')
+    parser.add_argument('--file-type', default='ppd', choices=['ppd', 'csv'])
+    parser.add_argument('--duration', type=float, default=None, help='Seconds, default: until interrupted.')
+    parser.add_argument('--status-interval', type=float, default=10, help='Seconds between status prints.')
+    args = parser.parse_args(args)
+    if args.data_dir and (not args.subject_IDs or len(args.subject_IDs) != len(args.ports)):
+        parser.error('--subject-IDs must give one subject ID per port when recording.')
+    acquisition = Headless_acquisition(args.ports, args.mode, args.sampling_rate, args.LED_current,
+                                       args.oversampling, not args.no_ambient_light_correction)
+    # Stop cleanly on ctrl+c or termination signal.
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signal_number, lambda *_: acquisition.stop_event.set())
+    try:
+        subject_IDs = dict(zip(args.ports, args.subject_IDs)) if args.data_dir else None
+        file_names = acquisition.start(args.data_dir, subject_IDs, args.file_type)
+        for port, file_name in file_names.items():
+            print('{}: recording to {}'.format(port, file_name), flush=True)
+        acquisition.run(args.duration, status_callback=print_status, status_interval=args.status_interval)
+        print_status(acquisition.get_metrics())
+    finally:
+        acquisition.close()
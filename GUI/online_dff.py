@@ -0,0 +1,60 @@
+# Code which runs on host computer and computes dF/F online from acquired signals.
+# Copyright (c) Thomas Akam 2018-2020.  Licenced under the GNU General Public License v3.
+
+import numpy as np
+
+from GUI.config import dFF_tau
+
+# Calcium signals for which dF/F is computed in each mode, as (calcium, isosbestic) indices
+# into the signals returned by Acquisition_board.process_data, isosbestic is None for
+# calcium signals without an isosbestic signal.
+dFF_channels = {'2 colour continuous': [(0, None), (1, None)],
+                '1 colour time div.' : [(0, 1)],
+                '2 colour time div.' : [(0, None), (1, None)],
+                '1site-3colors'      : [(0, 1), (2, None)],
+                '2sites-3colors'     : [(0, 1), (2, None)],
+                '1site-4colors'      : [(0, 1), (2, 3)],
+                '2sites-4colors'     : [(0, 1), (2, 3)]}
+
+class Online_dFF():
+    '''Computes dF/F of the calcium signals in data returned by Acquisition_board.process_data,
+    in O(new samples) per update.  For each calcium signal a recursive least squares fit of
+    the isosbestic signal to the calcium signal is maintained, with samples weighted by an
+    exponential forgetting factor with time constant tau seconds, so the fit tracks slow
+    changes such as bleaching.  The exponentially weighted mean of the calcium signal gives
+    a running baseline F, and dF is the calcium signal minus the fitted isosbestic signal,
+    which removes movement artifacts shared by both signals.  For calcium signals without
+    an isosbestic signal dF is the calcium signal minus the baseline.  The fit is updated
+    once per update, which is applied to its new samples.'''
+
+    def __init__(self, mode, sampling_rate, tau=dFF_tau):
+        self.channels = dFF_channels[mode]
+        self.decay = np.exp(-1/(tau*sampling_rate)) # Forgetting factor per sample.
+        self.sums = np.zeros((len(self.channels), 5)) # Weighted sums of [1, x, y, x*x, x*y] for each channel.
+        self.weights = np.ones(0) # Cached weights of new samples.
+        self.n_weights = 0
+
+    def update(self, data):
+        '''Update fits with new data and return list of dF/F arrays for new samples of
+        each calcium signal.'''
+        n = len(data[self.channels[0][0]])
+        if n != self.n_weights: # Weights of new samples, latest sample has weight 1.
+            self.weights = self.decay**np.arange(n-1, -1, -1)
+            self.n_weights = n
+        dFF = []
+        for sums, (calcium_i, isosbestic_i) in zip(self.sums, self.channels):
+            y = np.asarray(data[calcium_i], dtype=float)
+            x = np.asarray(data[isosbestic_i], dtype=float) if isosbestic_i is not None else np.zeros(n)
+            w = self.weights
+            sums *= self.decay**n
+            sums += (w.sum(), w @ x, w @ y, w @ (x*x), w @ (x*y))
+            S1, Sx, Sy, Sxx, Sxy = sums
+            if S1 == 0:
+                dFF.append(np.zeros(n))
+                continue
+            x_mean, y_mean = Sx/S1, Sy/S1
+            x_var = Sxx/S1 - x_mean**2
+            slope = (Sxy/S1 - x_mean*y_mean)/x_var if x_var > 1e-9*max(x_mean**2, 1) else 0.
+            fitted = slope*(x - x_mean) + y_mean # Isosbestic fitted to calcium.
+            dFF.append((y - fitted)/y_mean if y_mean > 0 else np.zeros(n))
+        return dFF
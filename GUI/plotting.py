@@ -6,7 +6,9 @@ import pyqtgraph as pg
 from datetime import datetime
 from pyqtgraph.Qt import QtGui, QtCore, QtWidgets
 
-from GUI.config import history_dur, triggered_dur
+from GUI.config import history_dur, triggered_dur, triggered_input, triggered_ema_tau
+from GUI.event_triggered import Event_triggered_average
+from GUI.online_dff import Online_dFF
 
 # Analog_plot ------------------------------------------------------
 
@@ -26,10 +28,13 @@ class Analog_plot(QtGui.QWidget):
         self.offset_spinbox.setMaximum(500)
         self.offset_spinbox.setFixedWidth(50)
         self.enable_disable_demean_mode()
+        self.dFF_checkbox = QtWidgets.QCheckBox('Plot dF/F')
+        self.dFF_checkbox.stateChanged.connect(self.enable_disable_dFF_mode)
         self.controls_layout = QtGui.QHBoxLayout()
         self.controls_layout.addWidget(self.demean_checkbox)
         self.controls_layout.addWidget(self.offset_label)
         self.controls_layout.addWidget(self.offset_spinbox)
+        self.controls_layout.addWidget(self.dFF_checkbox)
         self.controls_layout.addStretch()
         self.amblightcor_checkbox = QtWidgets.QCheckBox('Ambient light correction')
         self.controls_layout.addWidget(self.amblightcor_checkbox)
@@ -78,24 +83,37 @@ class Analog_plot(QtGui.QWidget):
                                          name='analog 1 (green isosbestic, 405nm excitation)')
             self.plot_3 = self.axis.plot(pen=pg.mkPen(color=(204,000,000)),
                                          name='analog 2 (red calcium, 550nm excitation)')
+        if self.mode in ('1site-4colors', '2sites-4colors'):
+            self.plots = [self.plot_1, self.plot_2, self.plot_3, self.plot_4]
+        elif self.mode in ('1site-3colors', '2sites-3colors'):
+            self.plots = [self.plot_1, self.plot_2, self.plot_3]
+        else:
+            self.plots = [self.plot_1, self.plot_2]
 
     def reset(self, sampling_rate):
         history_length = int(sampling_rate * history_dur)
         if self.mode in ('1site-4colors', '2sites-4colors'):
-            self.ADC1_green_ca  = Signal_history(history_length)
-            self.ADC1_green_iso = Signal_history(history_length)
-            self.ADC2_red_ca    = Signal_history(history_length)
-            self.ADC2_red_iso   = Signal_history(history_length)
+            self.ADC1_green_ca  = Decimated_history(history_length, sampling_rate)
+            self.ADC1_green_iso = Decimated_history(history_length, sampling_rate)
+            self.ADC2_red_ca    = Decimated_history(history_length, sampling_rate)
+            self.ADC2_red_iso   = Decimated_history(history_length, sampling_rate)
+            self.signals = [self.ADC1_green_ca, self.ADC1_green_iso, self.ADC2_red_ca, self.ADC2_red_iso] # Signal histories in order of plots.
         elif self.mode in ('1site-3colors', '2sites-3colors'):
-            self.ADC1_green_ca  = Signal_history(history_length)
-            self.ADC1_green_iso = Signal_history(history_length)
-            self.ADC2_red_ca    = Signal_history(history_length)
+            self.ADC1_green_ca  = Decimated_history(history_length, sampling_rate)
+            self.ADC1_green_iso = Decimated_history(history_length, sampling_rate)
+            self.ADC2_red_ca    = Decimated_history(history_length, sampling_rate)
+            self.signals = [self.ADC1_green_ca, self.ADC1_green_iso, self.ADC2_red_ca]
         else:
-            self.ADC1 = Signal_history(history_length)
-            self.ADC2 = Signal_history(history_length)
-        self.x = np.linspace(-history_dur, 0, history_length) # X axis for timeseries plots.
+            self.ADC1 = Decimated_history(history_length, sampling_rate)
+            self.ADC2 = Decimated_history(history_length, sampling_rate)
+            self.signals = [self.ADC1, self.ADC2]
+        self.dFF = Online_dFF(self.mode, sampling_rate)
+        self.dFF_signals = [Decimated_history(history_length, sampling_rate) for channel in self.dFF.channels]
 
     def update(self, input1, input2, input3, input4):
+        # Store new samples and their dF/F in signal histories, plots are redrawn by render.
+        for dFF_signal, new_dFF in zip(self.dFF_signals, self.dFF.update((input1, input2, input3, input4))):
+            dFF_signal.update(new_dFF)
         if self.mode in ('1site-4colors', '2sites-4colors', '1site-3colors', '2sites-3colors'):
             new_ADC1_green_ca  = input1
             new_ADC1_green_iso = input2
@@ -110,27 +128,6 @@ class Analog_plot(QtGui.QWidget):
                 new_ADC2_red_iso = input4
                 new_ADC2_red_iso   = 3.3 * new_ADC2_red_iso / (1 << 15)
                 self.ADC2_red_iso.update(new_ADC2_red_iso)
-            if self.AC_mode: 
-                # Plot signals with mean removed.
-                y1 = self.ADC1_green_ca.history - np.mean(self.ADC1_green_ca.history) \
-                    + 1.5*self.offset_spinbox.value()/1000
-                y2 = self.ADC1_green_iso.history - np.mean(self.ADC1_green_iso.history) \
-                    + 0.5*self.offset_spinbox.value()/1000
-                y3 = self.ADC2_red_ca.history - np.mean(self.ADC2_red_ca.history) \
-                    - 0.5*self.offset_spinbox.value()/1000
-                self.plot_1.setData(self.x, y1)
-                self.plot_2.setData(self.x, y2)
-                self.plot_3.setData(self.x, y3)
-                if self.mode in ('1site-4colors', '2sites-4colors'):
-                    y4 = self.ADC2_red_iso.history - np.mean(self.ADC2_red_iso.history) \
-                         - 1.5 * self.offset_spinbox.value() / 1000
-                    self.plot_4.setData(self.x, y4)
-            else:
-                self.plot_1.setData(self.x, self.ADC1_green_ca.history)
-                self.plot_2.setData(self.x, self.ADC1_green_iso.history)
-                self.plot_3.setData(self.x, self.ADC2_red_ca.history)
-                if self.mode in ('1site-4colors', '2sites-4colors'):
-                    self.plot_4.setData(self.x, self.ADC2_red_iso.history)
         else:
             new_ADC1 = input1
             new_ADC2 = input2
@@ -138,16 +135,33 @@ class Analog_plot(QtGui.QWidget):
             new_ADC2 = 3.3 * new_ADC2 / (1 << 15)
             self.ADC1.update(new_ADC1)
             self.ADC2.update(new_ADC2)
-            if self.AC_mode: 
-                # Plot signals with mean removed.
-                y1 = self.ADC1.history - np.mean(self.ADC1.history) \
-                     + self.offset_spinbox.value()/1000
-                y2 = self.ADC2.history - np.mean(self.ADC2.history)
-                self.plot_1.setData(self.x, y1)
-                self.plot_2.setData(self.x, y2)
-            else:
-                self.plot_1.setData(self.x, self.ADC1.history)
-                self.plot_2.setData(self.x, self.ADC2.history)
+
+    def render(self):
+        # Redraw plots from signal histories.
+        if self.dFF_checkbox.isChecked(): # Plot dF/F of calcium signals only.
+            for plot in self.plots:
+                plot.setData([], [])
+            for (calcium_i, isosbestic_i), dFF_signal in zip(self.dFF.channels, self.dFF_signals):
+                self.plots[calcium_i].setData(*dFF_signal.plot_data(self.axis.width()))
+            return
+        offset = self.offset_spinbox.value()/1000 # Volts.
+        if self.mode in ('1site-4colors', '2sites-4colors', '1site-3colors', '2sites-3colors'):
+            self.plot_signal(self.plot_1, self.ADC1_green_ca, 1.5*offset)
+            self.plot_signal(self.plot_2, self.ADC1_green_iso, 0.5*offset)
+            self.plot_signal(self.plot_3, self.ADC2_red_ca, -0.5*offset)
+            if self.mode in ('1site-4colors', '2sites-4colors'):
+                self.plot_signal(self.plot_4, self.ADC2_red_iso, -1.5*offset)
+        else:
+            self.plot_signal(self.plot_1, self.ADC1, offset)
+            self.plot_signal(self.plot_2, self.ADC2, 0)
+
+    def plot_signal(self, plot, signal, offset):
+        # Plot signal history decimated to the width of the axis, if in de-mean mode plot
+        # signal with mean removed, shifted by offset.
+        x, y = signal.plot_data(self.axis.width())
+        if self.AC_mode:
+            y = y - signal.mean + offset
+        plot.setData(x, y)
 
     def enable_disable_demean_mode(self):
         if self.demean_checkbox.isChecked():
@@ -160,6 +174,15 @@ class Analog_plot(QtGui.QWidget):
             self.offset_spinbox.setEnabled(False)
             self.offset_label.setStyleSheet('color : gray')
 
+    def enable_disable_dFF_mode(self):
+        if self.dFF_checkbox.isChecked():
+            self.demean_checkbox.setEnabled(False)
+            self.axis.setLabel('left', 'dF/F')
+            self.axis.enableAutoRange(axis='y')
+        else:
+            self.demean_checkbox.setEnabled(True)
+            self.axis.setLabel('left', 'Volts')
+
 # Digital_plot ------------------------------------------------------
 
 class Digital_plot():
@@ -174,69 +197,178 @@ class Digital_plot():
 
     def reset(self, sampling_rate):
         history_length = int(sampling_rate*history_dur)
-        self.DI1 = Signal_history(history_length, int) 
-        self.DI2 = Signal_history(history_length, int)
-        self.x = np.linspace(-history_dur, 0, history_length) # X axis for timeseries plots.
+        self.DI1 = Decimated_history(history_length, sampling_rate, int)
+        self.DI2 = Decimated_history(history_length, sampling_rate, int)
 
     def update(self, new_DI1, new_DI2):
         self.DI1.update(new_DI1)
         self.DI2.update(new_DI2)
-        self.plot_1.setData(self.x, self.DI1.history)
-        self.plot_2.setData(self.x, self.DI2.history)
+
+    def render(self):
+        self.plot_1.setData(*self.DI1.plot_data(self.axis.width()))
+        self.plot_2.setData(*self.DI2.plot_data(self.axis.width()))
  
 # Event triggered plot -------------------------------------------------
 
 class Event_triggered_plot():
 
-    def __init__(self, tau=5):
+    def __init__(self):
         self.axis = pg.PlotWidget(title="Event triggered", labels={'left': 'Volts', 'bottom':'Time (seconds)'})
         self.axis.addLegend(offset=(-10, 10))
-        self.prev_plot = self.axis.plot(pen=pg.mkPen(pg.hsvColor(0.6, sat=0, alpha=0.3)), name='latest')
-        self.ave_plot  = self.axis.plot(pen=pg.mkPen(pg.hsvColor(0.6)), name='average')
-        self.axis.addItem(pg.InfiniteLine(pos=0, angle=90, pen=pg.mkPen(style=QtCore.Qt.DotLine)))
         self.axis.setXRange(triggered_dur[0], triggered_dur[1], padding=0)
-        self.alpha = 1 - np.exp(-1./tau) # Learning rate for update of average trace, tau is time constant.
 
-    def reset(self, sampling_rate):
+    def reset(self, sampling_rate, analog):
+        # Create averager and plot items for the signals of analog plot, the average of each
+        # signal is plotted in the colour used by the analog plot with the SEM shaded.
         self.window = (np.array(triggered_dur)*sampling_rate).astype(int)   # Window for event triggered signals (samples [pre, post])
-        self.x = np.linspace(*triggered_dur, self.window[1]-self.window[0]) # X axis for event triggered plots.
-        self.average = None
-        self.prev_plot.clear()
-        self.ave_plot.clear()
-
-    def update(self, new_DI1, digital, analog, mode):
-        # Update event triggered average plot.
-        new_data_len = len(new_DI1)
-        trig_section = digital.DI1.history[-self.window[1]-new_data_len-1:-self.window[1]]
-        rising_edges = np.where(np.diff(trig_section)==1)[0]
-        for i, edge in enumerate(rising_edges):
-            edge_ind = -self.window[1]-new_data_len-1+edge # Position of edge in signal history.
-            if mode in ('1site-4colors', '2sites-4colors', '1site-3colors', '2sites-3colors'):
-                ev_trig_sig = analog.ADC1_green_ca.history[edge_ind + self.window[0]:edge_ind + self.window[1]]
-            else:
-                ev_trig_sig = analog.ADC1.history[edge_ind+self.window[0]:edge_ind+self.window[1]]
-            if self.average is None: # First acquisition
-                self.average = ev_trig_sig
-            else: # Update averaged trace.
-                self.average = (1-self.alpha)*self.average + self.alpha*ev_trig_sig
-            if i+1 == len(rising_edges): 
-                self.prev_plot.setData(self.x, ev_trig_sig)
-                self.ave_plot.setData(self.x, self.average)
+        self.x = np.arange(*self.window)/sampling_rate # X axis for event triggered plots.
+        self.average = Event_triggered_average(self.window, len(analog.signals), triggered_ema_tau)
+        self.n_rendered = 0 # Number of events when last rendered.
+        self.axis.clear()
+        self.axis.addItem(pg.InfiniteLine(pos=0, angle=90, pen=pg.mkPen(style=QtCore.Qt.DotLine)))
+        self.prev_plot = self.axis.plot(pen=pg.mkPen(pg.hsvColor(0.6, sat=0, alpha=0.3)), name='latest')
+        self.ave_plots = []
+        for analog_plot in analog.plots:
+            colour = analog_plot.opts['pen'].color()
+            ave_plot = self.axis.plot(pen=pg.mkPen(colour), name=analog_plot.opts['name'])
+            upper_plot, lower_plot = pg.PlotCurveItem(pen=None), pg.PlotCurveItem(pen=None) # SEM bounds.
+            colour.setAlpha(60)
+            self.axis.addItem(pg.FillBetweenItem(upper_plot, lower_plot, brush=pg.mkBrush(colour)))
+            self.ave_plots.append((ave_plot, upper_plot, lower_plot))
+
+    def update(self, new_data_len, digital, analog):
+        # Update event triggered averages with events in new data, plots are redrawn by render.
+        trigger = digital.DI1 if triggered_input == 1 else digital.DI2
+        self.average.update([signal.history for signal in analog.signals], trigger.history, new_data_len)
+
+    def render(self):
+        if self.average.n_events == self.n_rendered:
+            return
+        self.n_rendered = self.average.n_events
+        average = self.average.ema if triggered_ema_tau else self.average.mean
+        sem = self.average.sem
+        self.prev_plot.setData(self.x, self.average.latest[0])
+        for i, (ave_plot, upper_plot, lower_plot) in enumerate(self.ave_plots):
+            ave_plot.setData(self.x, average[i])
+            upper_plot.setData(self.x, average[i] + sem[i])
+            lower_plot.setData(self.x, average[i] - sem[i])
 
 # Signal_history ------------------------------------------------------------
 
 class Signal_history():
-    # Buffer to store the recent history of a signal.
+    # Buffer to store the recent history of a signal.  The buffer is a ring of twice the
+    # history length in which each sample is written twice, history_length samples apart,
+    # so the history is always a contiguous view of the buffer and updates only copy the
+    # new samples.  If stats is True the sum and sum of squares of the history are updated
+    # from the new and overwritten samples to give its mean and standard deviation, and are
+    # recomputed exactly each time the write index wraps to stop rounding errors accumulating.
+
+    def __init__(self, history_length, dtype=float, stats=True):
+        self.history_length = history_length
+        self.stats = stats
+        self.buffer = np.zeros(2*history_length, dtype)
+        self.write_ind = 0 # Buffer index where next sample is written, first sample of history.
+        self.sum = 0.    # Sum of history.
+        self.sum_sq = 0. # Sum of squares of history.
+
+    @property
+    def mean(self):
+        return self.sum/self.history_length
+
+    @property
+    def std(self):
+        return np.sqrt(max(self.sum_sq/self.history_length - self.mean**2, 0))
 
-    def __init__(self, history_length, dtype=float):
-        self.history = np.zeros(history_length, dtype)
+    @property
+    def history(self):
+        # View of the history, oldest sample first, valid until the next update.
+        return self.buffer[self.write_ind:self.write_ind+self.history_length]
 
     def update(self, new_data):
-        # Move old data along buffer, store new data samples.
+        # Store new data samples, overwriting the oldest samples.
+        new_data = new_data[max(len(new_data)-self.history_length, 0):]
         data_len = len(new_data)
-        self.history = np.roll(self.history, -data_len)
-        if len(new_data) > 0:
-            self.history[-data_len:] = new_data
+        if data_len == 0:
+            return
+        if self.stats:
+            old_data = self.history[:data_len] # Samples to be overwritten.
+            self.sum += _sum(new_data) - _sum(old_data)
+            self.sum_sq += _sum_sq(new_data) - _sum_sq(old_data)
+        n_end = min(data_len, self.history_length - self.write_ind) # Samples written before wrapping.
+        for start in (self.write_ind, self.write_ind + self.history_length):
+            self.buffer[start:start+n_end] = new_data[:n_end]
+        if n_end < data_len: # Wrap to start of ring.
+            for start in (0, self.history_length):
+                self.buffer[start:start+data_len-n_end] = new_data[n_end:]
+        if self.stats and self.write_ind + data_len >= self.history_length: # Write index wraps.
+            self.sum, self.sum_sq = _sum(self.history), _sum_sq(self.history)
+        self.write_ind = (self.write_ind + data_len) % self.history_length
+
+def _sum(x):
+    return float(np.sum(x, dtype=float))
+
+def _sum_sq(x):
+    x = np.asarray(x, dtype=float)
+    return float(np.dot(x, x))
+
+# Decimated_history ---------------------------------------------------------
+
+class Decimated_history(Signal_history):
+    # Signal history which also keeps a pyramid of decimated copies of the history for
+    # plotting.  Level k of the pyramid holds the minimum and maximum of each block of 
+    # 2**(k+1) samples, and is updated from the new blocks completed at level k-1, so
+    # updates cost O(new samples).  plot_data returns the finest level with no more 
+    # blocks than pixels, so the cost of plotting is independent of history length.
+
+    def __init__(self, history_length, sampling_rate, dtype=float, min_blocks=100):
+        super().__init__(history_length, dtype)
+        self.sampling_rate = sampling_rate
+        self.n_written = 0 # Total number of samples written.
+        self.x = np.arange(1-history_length, 1)/sampling_rate # Sample times relative to latest sample (seconds).
+        self.levels = [] # [(block minima, block maxima)] for each level as Signal_histories.
+        self.level_x = [] # Times of block start and end relative to end of latest complete block (samples).
+        n_blocks, block_size = history_length//2, 2
+        while n_blocks >= min_blocks:
+            self.levels.append((Signal_history(n_blocks, dtype, stats=False),
+                                Signal_history(n_blocks, dtype, stats=False)))
+            block_starts = np.arange(-n_blocks, 0)*block_size
+            self.level_x.append(np.stack([block_starts, block_starts+block_size-1], axis=1).ravel())
+            n_blocks, block_size = n_blocks//2, block_size*2
+        self.carry = [None]*len(self.levels) # (min, max) of block waiting to be paired at each level.
+
+    def update(self, new_data):
+        super().update(new_data)
+        self.n_written += len(new_data)
+        mins = maxs = np.asarray(new_data)
+        for k, (level_mins, level_maxs) in enumerate(self.levels):
+            if self.carry[k] is not None:
+                mins = np.concatenate(([self.carry[k][0]], mins))
+                maxs = np.concatenate(([self.carry[k][1]], maxs))
+                self.carry[k] = None
+            n_pairs = len(mins)//2
+            if len(mins) % 2:
+                self.carry[k] = (mins[-1], maxs[-1])
+            if n_pairs == 0:
+                break
+            mins = np.minimum(mins[0:2*n_pairs:2], mins[1:2*n_pairs:2])
+            maxs = np.maximum(maxs[0:2*n_pairs:2], maxs[1:2*n_pairs:2])
+            level_mins.update(mins)
+            level_maxs.update(maxs)
+
+    def plot_data(self, n_pixels):
+        # Return x (seconds relative to latest sample) and y arrays to plot the history with
+        # about 2 points per pixel, as the minimum and maximum of each block of samples.
+        if self.history_length <= 2*n_pixels or not self.levels:
+            return self.x, self.history
+        k = next((k for k, (level_mins, level_maxs) in enumerate(self.levels)
+                  if level_mins.history_length <= n_pixels), len(self.levels)-1)
+        level_mins, level_maxs = self.levels[k]
+        y = np.empty(2*level_mins.history_length, self.buffer.dtype)
+        y[0::2] = level_mins.history
+        y[1::2] = level_maxs.history
+        n_incomplete = self.n_written % (2 << k) # Samples since end of latest complete block.
+        x = (self.level_x[k] - n_incomplete + 1)/self.sampling_rate
+        return x, y
 
 # Record_clock ----------------------------------------------------
 
@@ -57,44 +57,60 @@ class PyboardError(BaseException):
 class Pyboard:
     def __init__(self, serial_device, baudrate=115200):
         self.serial = serial.Serial(serial_device, baudrate=baudrate, interCharTimeout=1)
+        self.pending = b'' # Bytes read by read_until after the ending it was waiting for.
 
     def close(self):
         self.serial.close()
 
     def read_until(self, min_num_bytes, ending, timeout=10, data_consumer=None):
-        data = self.serial.read(min_num_bytes)
-        if data_consumer:
-            data_consumer(data)
-        timeout_count = 0
-        while True:
-            if data.endswith(ending):
-                break
-            elif self.serial.inWaiting() > 0:
-                new_data = self.serial.read(1)
-                data = data + new_data
-                if data_consumer:
-                    data_consumer(new_data)
-                #time.sleep(0.01)
-                timeout_count = 0
-            else:
-                timeout_count += 1
-                if timeout is not None and timeout_count >= 10 * timeout:
+        # Read all available bytes at once, waking as soon as new data arrives.  Bytes
+        # received after ending are kept for the next call.
+        data, self.pending = self.pending, b''
+        if len(data) < min_num_bytes:
+            data += self.serial.read(min_num_bytes - len(data))
+        search_start = max(0, min_num_bytes - len(ending))
+        serial_timeout = self.serial.timeout
+        self.serial.timeout = 0.1
+        last_data_time = time.time()
+        n_consumed = 0 # Bytes passed to data_consumer.
+        try:
+            while True:
+                i = data.find(ending, search_start)
+                if i >= 0:
+                    data, self.pending = data[:i+len(ending)], data[i+len(ending):]
+                if data_consumer and len(data) > n_consumed:
+                    data_consumer(data[n_consumed:])
+                    n_consumed = len(data)
+                if i >= 0:
                     break
-                time.sleep(0.1)
+                search_start = max(0, len(data) - len(ending) + 1)
+                new_data = self.serial.read(max(1, self.serial.in_waiting))
+                if new_data:
+                    data = data + new_data
+                    last_data_time = time.time()
+                elif timeout is not None and time.time() - last_data_time >= timeout:
+                    break
+        finally:
+            self.serial.timeout = serial_timeout
         return data
 
-    def enter_raw_repl(self):
+    def enter_raw_repl(self, soft_reset=True):
         self.serial.write(b'\r\x03\x03') # ctrl-C twice: interrupt any running program
         # flush input (without relying on serial.flushInput())
         n = self.serial.inWaiting()
         while n > 0:
             self.serial.read(n)
             n = self.serial.inWaiting()
+        self.pending = b''
         self.serial.write(b'\r\x01') # ctrl-A: enter raw REPL
         data = self.read_until(1, b'to exit\r\n>')
         if not data.endswith(b'raw REPL; CTRL-B to exit\r\n>'):
             print(data)
             raise PyboardError('could not enter raw repl')
+        if soft_reset:
+            self.soft_reset()
+
+    def soft_reset(self):
         self.serial.write(b'\x04') # ctrl-D: soft reset
         data = self.read_until(1, b'to exit\r\n>')
         if not data.endswith(b'raw REPL; CTRL-B to exit\r\n>'):
@@ -0,0 +1,15 @@
+# Acquire data from pyPhotometry boards without the GUI, see GUI/headless.py for usage.
+
+import sys
+
+# Check dependencies are installed.
+try:
+    import numpy
+    import serial
+except Exception as e:
+    print('Unable to import dependencies:\n\n'+str(e))
+    sys.exit(1)
+
+# Run headless acquisition.
+from GUI.headless import main
+main()
@@ -3,9 +3,11 @@
 
 import json
 import numpy as np
-from scipy.signal import butter, filtfilt
+from collections.abc import Mapping
+from numpy.lib.mixins import NDArrayOperatorsMixin
+from scipy.signal import butter, filtfilt, sosfilt, sosfilt_zi
 
-def import_ppd(file_path, low_pass=20, high_pass=0.01):
+def import_ppd(file_path, low_pass=20, high_pass=0.01, lazy=False):
     '''Function to import pyPhotometry binary data files into Python. The high_pass 
     and low_pass arguments determine the frequency in Hz of highpass and lowpass 
     filtering applied to the filtered analog signals. To disable highpass or lowpass
@@ -28,52 +30,310 @@ def import_ppd(file_path, low_pass=20, high_pass=0.01):
         'pulse_times_1' - Times of rising edges on digital input 1 (ms).
         'pulse_times_2' - Times of rising edges on digital input 2 (ms).
         'time'          - Time of each sample relative to start of recording (ms)
+    If lazy is True, the signals are returned as Channel objects which are only
+    decoded from the memory mapped file when used, in a read only Lazy_dict, so opening
+    a file takes constant time and memory however long the recording.  Indexing or
+    slicing a Channel, e.g. data['analog_1'][1000:2000], decodes only the requested
+    samples.  Using a Channel as an array, e.g. np.asarray(data['analog_1']) or in
+    arithmetic, decodes the whole signal, which is cached.  The pulse inds and times
+    are computed when first accessed.
     '''
     with open(file_path, 'rb') as f:
         header_size = int.from_bytes(f.read(2), 'little')
         data_header = f.read(header_size)
-        data = np.frombuffer(f.read(), dtype=np.dtype('<u2'))
+        n_bytes = f.seek(0, 2) - header_size - 2
+    if n_bytes >= 2:
+        data = np.memmap(file_path, dtype=np.dtype('<u2'), mode='r', offset=header_size+2,
+                         shape=(n_bytes//2,))
+    else: # np.memmap can not map an empty array.
+        data = np.zeros(0, dtype=np.dtype('<u2'))
     # Extract header information
     header_dict = json.loads(data_header)
     volts_per_division = header_dict['volts_per_division']
     sampling_rate = header_dict['sampling_rate']
-    # Extract signals.
-    analog  = data >> 1                     # Analog signal is most significant 15 bits.
-    digital = ((data & 1) == 1).astype(int) # Digital signal is least significant bit.
-    # Alternating samples are signals 1 and 2.
-    analog_1 = analog[ ::2] * volts_per_division[0]
-    analog_2 = analog[1::2] * volts_per_division[1]
-    digital_1 = digital[ ::2]
-    digital_2 = digital[1::2]
-    time = np.arange(analog_1.shape[0])*1000/sampling_rate # Time relative to start of recording (ms).
+    # Signals, alternating samples are signals 1 and 2.
+    analog_1 = Analog_channel(data, 0, volts_per_division[0])
+    analog_2 = Analog_channel(data, 1, volts_per_division[1])
+    digital_1 = Digital_channel(data, 0)
+    digital_2 = Digital_channel(data, 1)
+    time = Time_channel(len(analog_1), sampling_rate) # Time relative to start of recording (ms).
     # Filter signals with specified high and low pass frequencies (Hz).
-    if low_pass and high_pass:
-        b, a = butter(2, np.array([high_pass, low_pass])/(0.5*sampling_rate), 'bandpass')
-    elif low_pass:
-        b, a = butter(2, low_pass/(0.5*sampling_rate), 'low')
-    elif high_pass:
-        b, a = butter(2, high_pass/(0.5*sampling_rate), 'high')
-    if low_pass or high_pass:
-        analog_1_filt = filtfilt(b, a, analog_1)
-        analog_2_filt = filtfilt(b, a, analog_2)
+    b_a = filter_coefficients(low_pass, high_pass, sampling_rate)
+    if b_a:
+        padding = filter_padding(low_pass, high_pass, sampling_rate)
+        analog_1_filt = Filtered_channel(analog_1, *b_a, padding)
+        analog_2_filt = Filtered_channel(analog_2, *b_a, padding)
     else:
         analog_1_filt = analog_2_filt = None
-    # Extract rising edges for digital inputs.
-    pulse_inds_1 = 1+np.where(np.diff(digital_1) == 1)[0]
-    pulse_inds_2 = 1+np.where(np.diff(digital_2) == 1)[0]
-    pulse_times_1 = pulse_inds_1*1000/sampling_rate
-    pulse_times_2 = pulse_inds_2*1000/sampling_rate
-    # Return signals + header information as a dictionary.
+    if not lazy: # Return signals + header information as a dictionary.
+        data_dict = {'analog_1'      : np.asarray(analog_1),
+                     'analog_2'      : np.asarray(analog_2),
+                     'analog_1_filt' : np.asarray(analog_1_filt) if b_a else None,
+                     'analog_2_filt' : np.asarray(analog_2_filt) if b_a else None,
+                     'digital_1'     : np.asarray(digital_1),
+                     'digital_2'     : np.asarray(digital_2),
+                     'pulse_inds_1'  : rising_edges(digital_1),
+                     'pulse_inds_2'  : rising_edges(digital_2),
+                     'pulse_times_1' : rising_edges(digital_1)*1000/sampling_rate,
+                     'pulse_times_2' : rising_edges(digital_2)*1000/sampling_rate,
+                     'time'          : np.asarray(time)}
+        data_dict.update(header_dict)
+        return data_dict
+    # Return Lazy_dict of signals + header information, with rising edges of digital
+    # inputs extracted when first accessed.
     data_dict = {'analog_1'      : analog_1,
                  'analog_2'      : analog_2,
                  'analog_1_filt' : analog_1_filt,
                  'analog_2_filt' : analog_2_filt,
                  'digital_1'     : digital_1,
                  'digital_2'     : digital_2,
-                 'pulse_inds_1'  : pulse_inds_1,
-                 'pulse_inds_2'  : pulse_inds_2,
-                 'pulse_times_1' : pulse_times_1,
-                 'pulse_times_2' : pulse_times_2,
                  'time'          : time}
     data_dict.update(header_dict)
-    return data_dict
\ No newline at end of file
+    lazy_items = {'pulse_inds_1' : lambda: rising_edges(digital_1),
+                  'pulse_inds_2' : lambda: rising_edges(digital_2),
+                  'pulse_times_1': lambda: rising_edges(digital_1)*1000/sampling_rate,
+                  'pulse_times_2': lambda: rising_edges(digital_2)*1000/sampling_rate}
+    return Lazy_dict(data_dict, lazy_items)
+
+# Reading in blocks --------------------------------------------------------------------
+
+def read_ppd_blocks(file_path, block_size=2**16, low_pass=20, high_pass=0.01, zero_phase=False,
+                    padding=None):
+    '''Generator which reads a pyPhotometry binary data file in blocks of block_size
+    samples per signal, so recordings of any length can be processed in constant memory.
+    Yields a dictionary for each block with the header information and the items
+    returned by import_ppd, computed for the samples in the block, with sample indices
+    and times relative to the start of the recording, and the additional item:
+        'first_sample'  - Index of the first sample in the block.
+    Filter state is carried across blocks.  If zero_phase is False the filtered
+    signals are causally filtered, which matches filtering the whole signal in one go.
+    If zero_phase is True the signals are filtered forward and backward as by import_ppd.
+    The forward filter state is carried across blocks and each block is filtered forward
+    over the following padding samples, from which the backward filter is run, so the
+    filtered signals match filtering the whole signal to within the decay of the filter's
+    impulse response over the padding, by default several periods of the lowest filter
+    frequency.  At the start and end of the recording the signal is extended as by
+    filtfilt, so the ends also match.  Rising edges spanning block boundaries are detected by carrying the last
+    sample of each digital signal across blocks.'''
+    data = import_ppd(file_path, low_pass=None, high_pass=None, lazy=True)
+    sampling_rate = data['sampling_rate']
+    header_dict = {key: data[key] for key in data
+                   if not key.startswith(('analog_', 'digital_', 'pulse_', 'time'))}
+    analog = [data['analog_1'], data['analog_2']]
+    digital = [data['digital_1'], data['digital_2']]
+    n_samples = len(analog[0])
+    sos = filter_coefficients(low_pass, high_pass, sampling_rate, output='sos')
+    if sos is not None:
+        if padding is None:
+            padding = filter_padding(low_pass, high_pass, sampling_rate) if zero_phase else 0
+        zi = sosfilt_zi(sos) # Filter state for unit step input.
+        edge_padding = 3*(2*len(sos)+1) # Length of odd extension at ends of signal used by filtfilt.
+        forward_state = [None, None]
+    last_digital = [None, None] # Last sample of previous block for each digital signal.
+    for start in range(0, n_samples, block_size):
+        stop = min(start + block_size, n_samples)
+        block = {'first_sample': start, 'time': data['time'][start:stop]}
+        for i in (0, 1):
+            name = str(i+1)
+            # Signal 2 is one sample shorter than signal 1 if the file ends part way through a pair.
+            n_signal = len(analog[i])
+            signal_stop = min(stop, n_signal)
+            # Analog signals.
+            signal = analog[i][start:signal_stop]
+            block['analog_' + name] = signal
+            if sos is None:
+                block['analog_' + name + '_filt'] = None
+            elif len(signal) == 0:
+                block['analog_' + name + '_filt'] = np.zeros(0)
+            elif zero_phase and n_signal <= edge_padding: # Too short for filtfilt.
+                block['analog_' + name + '_filt'] = np.full(len(signal), np.nan)
+            else:
+                if forward_state[i] is None:
+                    if zero_phase: # Filter forward over odd extension of start of signal.
+                        head = analog[i][:edge_padding+1]
+                        extension = 2*head[0] - head[:0:-1]
+                        forward_state[i] = sosfilt(sos, extension, zi=zi*extension[0])[1]
+                    else: # Initialise filter state as for constant input.
+                        forward_state[i] = zi*signal[0]
+                filtered, forward_state[i] = sosfilt(sos, signal, zi=forward_state[i])
+                if zero_phase:
+                    lookahead = analog[i][signal_stop:signal_stop+padding]
+                    if signal_stop + padding >= n_signal: # Add odd extension of end of signal.
+                        tail = analog[i][n_signal-edge_padding-1:]
+                        lookahead = np.concatenate([lookahead, 2*tail[-1] - tail[-2::-1]])
+                    filtered = np.concatenate([filtered, sosfilt(sos, lookahead, zi=forward_state[i])[0]])
+                    filtered = sosfilt(sos, filtered[::-1], zi=zi*filtered[-1])[0][::-1][:len(signal)]
+                block['analog_' + name + '_filt'] = filtered
+            # Digital signals and rising edges.
+            signal = digital[i][start:signal_stop]
+            block['digital_' + name] = signal
+            if last_digital[i] is None:
+                pulse_inds = 1+np.where(np.diff(signal) == 1)[0]
+            else:
+                pulse_inds = np.where(np.diff(signal, prepend=last_digital[i]) == 1)[0]
+            if len(signal):
+                last_digital[i] = signal[-1]
+            block['pulse_inds_' + name] = start + pulse_inds
+            block['pulse_times_' + name] = (start + pulse_inds)*1000/sampling_rate
+        block.update(header_dict)
+        yield block
+
+# Filtering ------------------------------------------------------------------------------
+
+def filter_coefficients(low_pass, high_pass, sampling_rate, output='ba'):
+    '''Return coefficients of the filter with the specified high and low pass
+    frequencies (Hz), as (b, a) or second order sections depending on output, or
+    None if neither frequency is specified.'''
+    if low_pass and high_pass:
+        return butter(2, np.array([high_pass, low_pass])/(0.5*sampling_rate), 'bandpass', output=output)
+    elif low_pass:
+        return butter(2, low_pass/(0.5*sampling_rate), 'low', output=output)
+    elif high_pass:
+        return butter(2, high_pass/(0.5*sampling_rate), 'high', output=output)
+    return None
+
+def filter_padding(low_pass, high_pass, sampling_rate):
+    '''Number of samples either side of a segment which are filtered with it so that
+    the filtered segment matches filtering the whole signal, several periods of the
+    lowest filter frequency, after which the filter's impulse response has decayed.'''
+    return int(np.ceil(3*sampling_rate/min(f for f in (low_pass, high_pass) if f)))
+
+# Channels -------------------------------------------------------------------------------
+
+class Channel(NDArrayOperatorsMixin):
+    '''Signal whose samples are computed when used.  Subclasses implement _read(start, stop)
+    which returns an array of samples start to stop.  Slices are computed with _read, and
+    the whole signal is computed and cached when the channel is used as an array.'''
+
+    def __init__(self, n_samples):
+        self.n_samples = n_samples
+        self._array = None # Whole signal, once computed.
+
+    def _read(self, start, stop):
+        raise NotImplementedError
+
+    def __len__(self):
+        return self.n_samples
+
+    @property
+    def shape(self):
+        return (self.n_samples,)
+
+    @property
+    def size(self):
+        return self.n_samples
+
+    @property
+    def dtype(self):
+        return self._read(0, 0).dtype
+
+    ndim = 1
+
+    def __getitem__(self, key):
+        if self._array is not None:
+            return self._array[key]
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.n_samples)
+            if step > 0:
+                return self._read(start, max(start, stop))[::step]
+        elif isinstance(key, (int, np.integer)):
+            i = range(self.n_samples)[key] # Raises IndexError if out of range.
+            return self._read(i, i+1)[0]
+        return np.asarray(self)[key]
+
+    def __array__(self, dtype=None, copy=None):
+        if self._array is None:
+            self._array = self._read(0, self.n_samples)
+        array = self._array if dtype is None else self._array.astype(dtype, copy=False)
+        return array.copy() if copy and array is self._array else array
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        inputs = [np.asarray(x) if isinstance(x, Channel) else x for x in inputs]
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+    def __repr__(self):
+        return '{}({} samples)'.format(type(self).__name__, self.n_samples)
+
+class Analog_channel(Channel):
+    '''Analog signal in volts from every other sample of the memory mapped data.'''
+
+    def __init__(self, data, offset, volts_per_division):
+        self.samples = data[offset::2]
+        self.volts_per_division = volts_per_division
+        super().__init__(len(self.samples))
+
+    def _read(self, start, stop):
+        return (self.samples[start:stop] >> 1) * self.volts_per_division # Analog signal is most significant 15 bits.
+
+class Digital_channel(Channel):
+    '''Digital signal from every other sample of the memory mapped data.'''
+
+    def __init__(self, data, offset):
+        self.samples = data[offset::2]
+        super().__init__(len(self.samples))
+
+    def _read(self, start, stop):
+        return ((self.samples[start:stop] & 1) == 1).astype(int) # Digital signal is least significant bit.
+
+class Time_channel(Channel):
+    '''Time of each sample relative to start of recording (ms).'''
+
+    def __init__(self, n_samples, sampling_rate):
+        self.sampling_rate = sampling_rate
+        super().__init__(n_samples)
+
+    def _read(self, start, stop):
+        return np.arange(start, stop)*1000/self.sampling_rate
+
+class Filtered_channel(Channel):
+    '''Zero phase filtered signal.  Segments are filtered together with padding samples
+    either side, so they match filtering the whole signal to within the decay of the
+    filter's impulse response over the padding.'''
+
+    def __init__(self, channel, b, a, padding):
+        self.channel = channel
+        self.b, self.a = b, a
+        self.padding = padding
+        super().__init__(len(channel))
+
+    def _read(self, start, stop):
+        padded_start = max(start - self.padding, 0)
+        padded_stop = min(stop + self.padding, self.n_samples)
+        signal = self.channel[padded_start:padded_stop]
+        if len(signal) <= 3*max(len(self.a), len(self.b)): # Too short for filtfilt.
+            return np.full(stop-start, np.nan)
+        return filtfilt(self.b, self.a, signal)[start-padded_start:stop-padded_start]
+
+def rising_edges(digital, block_size=2**20):
+    '''Return locations of rising edges in a digital signal (samples), read in blocks
+    of block_size samples to limit memory use.'''
+    edges = []
+    for start in range(0, len(digital), block_size):
+        previous = max(start-1, 0) # Include last sample of previous block.
+        block = digital[previous:start+block_size]
+        edges.append(previous+1+np.where(np.diff(block) == 1)[0])
+    return np.concatenate(edges) if edges else np.zeros(0, dtype=int)
+
+# Lazy_dict ------------------------------------------------------------------------------
+
+class Lazy_dict(Mapping):
+    '''Read only dictionary where the values of lazy_items are computed by calling the
+    corresponding function when first accessed.'''
+
+    def __init__(self, items, lazy_items):
+        self._items = dict(items)
+        self._lazy_items = dict(lazy_items)
+
+    def __getitem__(self, key):
+        if key in self._lazy_items:
+            self._items[key] = self._lazy_items.pop(key)()
+        return self._items[key]
+
+    def __iter__(self):
+        return iter(list(self._items) + list(self._lazy_items))
+
+    def __len__(self):
+        return len(self._items) + len(self._lazy_items)
+
+    def __repr__(self):
+        return 'Lazy_dict({})'.format(list(self))
@@ -0,0 +1,232 @@
+# Mock versions of the MicroPython pyb and machine modules, used to run the photometry
+# firmware under CPython and count the operations executed by its interrupt service routines.
+# Copyright (c) Thomas Akam 2018-2020.  Licenced under the GNU General Public License v3.
+#
+# Usage from the repository root:
+#     python -m tools.mock_pyb [--firmware PATH] [--compare PATH] [--n-calls N]
+# e.g. to compare the ISRs with those of an earlier firmware version:
+#     git show <commit>:uPy/photometry_upy.py > old_photometry_upy.py
+#     python -m tools.mock_pyb --compare old_photometry_upy.py
+
+import sys
+import time
+import types
+import argparse
+from collections import Counter
+
+hardware_ops = Counter() # Number of calls to each mock hardware method.
+
+# Mock pyb module ------------------------------------------------------------------------
+
+class ADC():
+    def __init__(self, pin):
+        self.pin = pin
+        self.value = 1000 # Value returned by reads.
+
+    def read(self):
+        hardware_ops['ADC.read'] += 1
+        return self.value
+
+    def read_timed(self, buf, timer):
+        hardware_ops['ADC.read_timed'] += 1
+        for i in range(len(buf)):
+            buf[i] = self.value
+
+class Pin():
+    IN = 0
+    OUT = 1
+    PULL_DOWN = 2
+
+    def __init__(self, name, mode=IN, pull=None):
+        self.name = name
+        self._value = 0
+
+    def value(self, value=None):
+        hardware_ops['Pin.value'] += 1
+        if value is None:
+            return self._value
+        self._value = value
+
+class DAC():
+    def __init__(self, channel, bits=8):
+        self.channel = channel
+        self._value = 0
+
+    def write(self, value):
+        hardware_ops['DAC.write'] += 1
+        self._value = value
+
+class Timer():
+    def __init__(self, n):
+        self.n = n
+        self._callback = None
+
+    def init(self, freq=None):
+        self.freq = freq
+
+    def deinit(self):
+        self._callback = None
+
+    def callback(self, func):
+        self._callback = func
+
+class USB_VCP():
+    '''Mock USB_VCP whose read returns bytes from the input attribute, which by default
+    contains the stop signal, and which counts bytes sent.'''
+
+    def __init__(self):
+        self.input = bytearray(b'\xFF')
+        self.n_sent = 0
+
+    def setinterrupt(self, char):
+        pass
+
+    def any(self):
+        return len(self.input) > 0
+
+    def read(self, n):
+        data = bytes(self.input[:n])
+        del self.input[:n]
+        return data
+
+    def send(self, data):
+        hardware_ops['USB_VCP.send'] += 1
+        self.n_sent += len(data)
+        return len(data)
+
+    write = send
+
+def udelay(us):
+    hardware_ops['udelay'] += 1
+
+def delay(ms):
+    hardware_ops['delay'] += 1
+
+def disable_irq():
+    return True
+
+def enable_irq(state=True):
+    pass
+
+pyb = types.ModuleType('pyb')
+pyb.ADC, pyb.Pin, pyb.DAC, pyb.Timer, pyb.USB_VCP = ADC, Pin, DAC, Timer, USB_VCP
+pyb.udelay, pyb.delay, pyb.disable_irq, pyb.enable_irq = udelay, delay, disable_irq, enable_irq
+
+machine = types.ModuleType('machine')
+machine.Pin = Pin
+
+micropython = types.ModuleType('micropython')
+micropython.native = micropython.viper = lambda func: func
+
+gc = types.ModuleType('gc') # MicroPython gc functions, without affecting CPython's gc.
+gc.collect = gc.enable = gc.disable = lambda: None
+gc.mem_free = lambda: 100000 # Bytes.
+
+hardware_config = types.ModuleType('hardware_config')
+hardware_config.pins = {}
+hardware_config.LED_calibration = {'slope': 38.15, 'offset': 6.26}
+hardware_config.ADC_volts_per_division = [0.00010122, 0.00010122]
+
+# Loading firmware -----------------------------------------------------------------------
+
+def load_firmware(firmware_path='uPy/photometry_upy.py', pyb_module=pyb, machine_module=machine):
+    '''Execute the firmware source with the mock modules, return its namespace.'''
+    sys.modules.update({'pyb': pyb_module, 'machine': machine_module, 'hardware_config': hardware_config})
+    with open(firmware_path) as f:
+        source = f.read()
+    namespace = {'__name__': 'photometry_upy', 'micropython': micropython}
+    exec(compile(source, firmware_path, 'exec'), namespace)
+    namespace['gc'] = gc
+    return types.SimpleNamespace(**namespace)
+
+def started_photometry(firmware, mode, sampling_rate=100, buffer_size=20):
+    '''Return Photometry instance set up as by start(), with the mock USB_VCP sending
+    the stop signal so start returns immediately.'''
+    p = firmware.Photometry()
+    p.set_mode(mode)
+    p.set_LED_current(10, 10)
+    p.set_ambientlightcorrection(True)
+    p.start(sampling_rate, buffer_size)
+    return p
+
+# Counting operations --------------------------------------------------------------------
+
+class Bytecode_counter():
+    '''Counts bytecodes and lines executed in code from file_name while started.'''
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.counts = Counter()
+
+    def _trace_calls(self, frame, event, arg):
+        if frame.f_code.co_filename != self.file_name:
+            return None
+        frame.f_trace_opcodes = True
+        return self._trace_frame
+
+    def _trace_frame(self, frame, event, arg):
+        if event in ('opcode', 'line'):
+            self.counts[event] += 1
+        return self._trace_frame
+
+    def start(self):
+        sys.settrace(self._trace_calls)
+
+    def stop(self):
+        sys.settrace(None)
+
+def count_operations(func, n_calls, file_name):
+    '''Call func n_calls times, return the average number of bytecodes and lines executed
+    in code from file_name and of calls to each mock hardware method per call.'''
+    bytecode_counter = Bytecode_counter(file_name)
+    counts = bytecode_counter.counts
+    hardware_ops.clear()
+    bytecode_counter.start()
+    try:
+        for i in range(n_calls):
+            func(None)
+    finally:
+        bytecode_counter.stop()
+    op_counts = {'bytecodes': counts['opcode']/n_calls, 'lines': counts['line']/n_calls}
+    op_counts.update({name: n/n_calls for name, n in sorted(hardware_ops.items())})
+    return op_counts
+
+def time_calls(func, n_calls):
+    '''Average duration of calls to func under CPython (us), as a rough relative measure.'''
+    t0 = time.perf_counter()
+    for i in range(n_calls):
+        func(None)
+    return 1e6*(time.perf_counter() - t0)/n_calls
+
+def profile_ISRs(firmware_path, n_calls=1200):
+    '''Return {mode: operation counts} for the ISR used in each acquisition mode.'''
+    firmware = load_firmware(firmware_path)
+    results = {}
+    for mode in ['2 colour continuous', '1 colour time div.', '2 colour time div.',
+                 '1site-3colors', '1site-4colors', '2sites-3colors', '2sites-4colors']:
+        p = started_photometry(firmware, mode)
+        ISR = p.cont_2_col_ISR if mode == '2 colour continuous' else p.time_div_ISR
+        results[mode] = count_operations(ISR, n_calls, firmware_path)
+        results[mode]['CPython us'] = time_calls(ISR, n_calls)
+    return results
+
+def print_profile(results, compare_results=None):
+    for mode, op_counts in results.items():
+        print(f'\n{mode}')
+        for name, n in op_counts.items():
+            line = f'    {name:<16}{n:8.1f}'
+            if compare_results:
+                line += f'   (was {compare_results[mode].get(name, 0):8.1f})'
+            print(line)
+
+# Command line interface -----------------------------------------------------------------
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Count operations per call of the firmware ISRs.')
+    parser.add_argument('--firmware', default='uPy/photometry_upy.py')
+    parser.add_argument('--compare', default=None, help='Firmware file to compare against.')
+    parser.add_argument('--n-calls', type=int, default=1200)
+    args = parser.parse_args()
+    results = profile_ISRs(args.firmware, args.n_calls)
+    compare_results = profile_ISRs(args.compare, args.n_calls) if args.compare else None
+    print_profile(results, compare_results)
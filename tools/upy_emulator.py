@@ -0,0 +1,352 @@
+# Emulator which runs the photometry firmware under CPython, with the pyboard's ADCs,
+# DACs, pins, timers and USB serial emulated, to measure and regression test firmware
+# performance without hardware.
+# Copyright (c) Thomas Akam 2018-2020.  Licenced under the GNU General Public License v3.
+#
+# Usage from the repository root:
+#     python -m tools.upy_emulator [--mode MODE] [--sampling-rate RATE] [--protocol N] ...
+# which runs the firmware for the specified duration of virtual time, prints per ISR call
+# operation and allocation counts and checks the data sent by the firmware can be decoded
+# by the host.  To stream data from the emulated firmware to the GUI in real time use:
+#     python -m tools.virtual_pyboard --firmware uPy/photometry_upy.py
+
+import math
+import time
+import types
+import argparse
+import threading
+import tracemalloc
+import numpy as np
+from collections import Counter, defaultdict
+
+from tools import mock_pyb
+from GUI.acquisition_board import decode_chunk_v2
+
+# Emulated signals ----------------------------------------------------------------------
+
+# Light reaching each analog input pin, {ADC pin: {light source: ADC counts per unit}},
+# where light sources are DAC channels (counts per DAC value) and CoolLED pins.
+light_sources = {'X11': {'DAC1': 0.4, 'DAC2': 0.2, 'A0': 800, 'A2': 400},  # Green, site 1.
+                 'X12': {'DAC1': 0.1, 'DAC2': 0.3, 'A1': 800, 'A2': 150},  # Red, site 1.
+                 'Y11': {'DAC1': 0.4, 'DAC2': 0.2, 'A3': 800, 'A7': 400},  # Green, site 2.
+                 'Y12': {'DAC1': 0.1, 'DAC2': 0.3, 'A6': 800, 'A7': 150}}  # Red, site 2.
+
+ADC_baseline = 200 # ADC counts with no light.
+
+# Digital input pulses, {pin: (pulse duration, pulse interval)} (seconds).
+digital_pulses = {'Y7': (0.05, 1.0),  # Digital input 1.
+                  'Y8': (0.1 , 1.5)}  # Digital input 2.
+
+# Firmware_emulator ---------------------------------------------------------------------
+
+class Firmware_emulator():
+    '''Runs the photometry firmware under CPython with emulated hardware.  Timer callbacks
+    (the firmware ISRs) are called from a virtual clock which is advanced each time the
+    firmware's main loop polls the USB serial, jumping to the time of the next callback,
+    or if realtime is True waiting for it.  ADC reads return the light from the LEDs
+    currently driven (see light_sources) and digital inputs pulse periodically.  Bytes
+    written to USB_VCP go to usb.write and bytes read come from usb.read, where usb is
+    a Byte_pipe unless another object with the same interface is provided, e.g. a
+    Virtual_pyboard.  If profile is True the number of bytecodes executed and bytes
+    allocated by each ISR call are recorded in ISR_stats.  Allocations are those made by
+    CPython, e.g. for ints above 256, so are only a relative measure of allocations on
+    the pyboard.'''
+
+    def __init__(self, firmware_path='uPy/photometry_upy.py', realtime=False, usb=None,
+                 profile=False):
+        self.firmware_path = firmware_path
+        self.realtime = realtime
+        self.usb = usb if usb else Byte_pipe()
+        self.profile = profile
+        self.time = 0        # Virtual time (seconds).
+        self.time_origin = 0 # Wall clock time of virtual time 0 in realtime mode.
+        self.stop_time = None
+        self.timers = []     # Timers with a callback set.
+        self.pins = {}       # {pin name: Pin}
+        self.DACs = {}       # {channel: DAC}
+        self.ISR_stats = defaultdict(Counter)
+        self.bytecode_counter = mock_pyb.Bytecode_counter(firmware_path)
+        self.pyb, self.machine = self._make_modules()
+        self.firmware = mock_pyb.load_firmware(firmware_path, self.pyb, self.machine)
+        self.firmware.pyb = self.pyb
+
+    def _make_modules(self):
+        # Return pyb and machine modules whose hardware classes refer to this emulator.
+        attributes = {'emulator': self}
+        pyb = types.ModuleType('pyb')
+        pyb.ADC = type('ADC', (Emulated_ADC,), attributes)
+        pyb.Pin = type('Pin', (Emulated_pin,), attributes)
+        pyb.DAC = type('DAC', (Emulated_DAC,), attributes)
+        pyb.Timer = type('Timer', (Emulated_timer,), attributes)
+        pyb.USB_VCP = type('USB_VCP', (Emulated_USB_VCP,), attributes)
+        pyb.udelay, pyb.delay = mock_pyb.udelay, mock_pyb.delay
+        pyb.disable_irq, pyb.enable_irq = mock_pyb.disable_irq, mock_pyb.enable_irq
+        machine = types.ModuleType('machine')
+        machine.Pin = pyb.Pin
+        return pyb, machine
+
+    # Running the firmware -----------------------------------------------------
+
+    def run(self, mode, sampling_rate, buffer_size, duration, protocol=1, n_buffers=2,
+            oversampling=64, LED_current=(10, 10), ambient_light_correction=True):
+        '''Run acquisition with the firmware's Photometry.start for duration seconds of
+        virtual time then send the stop signal.  sampling_rate is the rate passed to
+        start by Acquisition_board.  Returns the bytes sent by the firmware.'''
+        p = self.firmware.Photometry()
+        p.set_mode(mode)
+        p.set_LED_current(*LED_current)
+        p.set_ambientlightcorrection(ambient_light_correction)
+        self.stop_time = self.time + duration
+        if self.profile:
+            tracemalloc.start()
+        try:
+            p.start(sampling_rate, buffer_size, protocol, n_buffers, oversampling)
+        finally:
+            if self.profile:
+                tracemalloc.stop()
+            self.stop_time = None
+        return self.usb.take_output()
+
+    def advance(self):
+        '''Call the next timer callback due, advancing the virtual clock to its time.  In
+        realtime mode returns without calling it if it is not yet due.'''
+        if self.stop_time is not None and self.time >= self.stop_time:
+            self.usb.stop_event.set()
+            return
+        if not self.timers:
+            return
+        timer = min(self.timers, key=lambda timer: timer.next_time)
+        if self.realtime:
+            wait = self.time_origin + timer.next_time - time.perf_counter()
+            if wait > 0:
+                time.sleep(min(wait, 0.001)) # Stay responsive to bytes from host.
+                return
+        self.time = timer.next_time
+        timer.next_time += 1/timer.freq
+        self._call_ISR(timer._callback, timer)
+
+    def _call_ISR(self, ISR, timer):
+        if not self.profile:
+            ISR(timer)
+            return
+        # Bytecodes and allocations are measured on alternate blocks of 12 calls, so the
+        # bytecode counter does not allocate during allocation measurement, and each block
+        # covers whole cycles of the 2, 3 and 4 step time division ISRs.
+        stats = self.ISR_stats[ISR.__name__]
+        if (stats['calls'] // 12) % 2:
+            opcodes = self.bytecode_counter.counts['opcode']
+            self.bytecode_counter.start()
+            ISR(timer)
+            self.bytecode_counter.stop()
+            stats['bytecodes'] += self.bytecode_counter.counts['opcode'] - opcodes
+            stats['bytecode calls'] += 1
+        else:
+            tracemalloc.reset_peak()
+            memory_before = tracemalloc.get_traced_memory()[0]
+            ISR(timer)
+            peak = tracemalloc.get_traced_memory()[1]
+            stats['bytes allocated'] += peak - memory_before
+            stats['allocation calls'] += 1
+        stats['calls'] += 1
+
+    def ISR_profile(self):
+        '''Return {ISR name: {measure: mean per call}} from the recorded ISR_stats.'''
+        profile = {}
+        for name, stats in self.ISR_stats.items():
+            profile[name] = {
+                'calls': stats['calls'],
+                'bytecodes': stats['bytecodes']/max(stats['bytecode calls'], 1),
+                'bytes allocated': stats['bytes allocated']/max(stats['allocation calls'], 1)}
+        return profile
+
+    # Emulated signals ---------------------------------------------------------
+
+    def ADC_value(self, pin):
+        '''Value read by the ADC on pin at the current virtual time.'''
+        light = 0
+        for source, gain in light_sources.get(pin, {}).items():
+            if source.startswith('DAC'):
+                DAC = self.DACs.get(int(source[3:]))
+                light += gain*DAC._value if DAC else 0
+            elif source in self.pins:
+                light += gain*self.pins[source]._value
+        light *= 1 + 0.05*math.sin(2*math.pi*0.5*self.time) # Slow oscillation.
+        return min(int(ADC_baseline + light), 4095)
+
+    def digital_value(self, pin):
+        '''Value of digital input pin at the current virtual time.'''
+        pulse_dur, pulse_interval = digital_pulses[pin]
+        return int(self.time % pulse_interval < pulse_dur)
+
+# Emulated hardware ---------------------------------------------------------------------
+
+class Emulated_ADC(mock_pyb.ADC):
+
+    def read(self):
+        mock_pyb.hardware_ops['ADC.read'] += 1
+        return self.emulator.ADC_value(self.pin)
+
+    def read_timed(self, buf, timer):
+        mock_pyb.hardware_ops['ADC.read_timed'] += 1
+        value = self.emulator.ADC_value(self.pin)
+        for i in range(len(buf)):
+            buf[i] = value
+
+class Emulated_pin(mock_pyb.Pin):
+
+    def __init__(self, name, mode=mock_pyb.Pin.IN, pull=None):
+        super().__init__(name, mode, pull)
+        self.emulator.pins[name] = self
+
+    def value(self, value=None):
+        if value is None and self.name in digital_pulses:
+            mock_pyb.hardware_ops['Pin.value'] += 1
+            return self.emulator.digital_value(self.name)
+        return super().value(value)
+
+class Emulated_DAC(mock_pyb.DAC):
+
+    def __init__(self, channel, bits=8):
+        super().__init__(channel, bits)
+        self.emulator.DACs[channel] = self
+
+class Emulated_timer(mock_pyb.Timer):
+
+    def deinit(self):
+        super().deinit()
+        if self in self.emulator.timers:
+            self.emulator.timers.remove(self)
+
+    def callback(self, func):
+        super().callback(func)
+        emulator = self.emulator
+        if func is None:
+            self.deinit()
+        elif self not in emulator.timers:
+            self.next_time = emulator.time + 1/self.freq
+            if not emulator.timers:
+                emulator.time_origin = time.perf_counter() - emulator.time
+            emulator.timers.append(self)
+
+class Emulated_USB_VCP(mock_pyb.USB_VCP):
+    '''USB_VCP whose any method advances the emulator's virtual clock.  Once the usb
+    stop_event is set reads return the firmware's stop signal.'''
+
+    def any(self):
+        self.emulator.advance()
+        usb = self.emulator.usb
+        return usb.stop_event.is_set() or usb.any() > 0
+
+    def read(self, n):
+        usb = self.emulator.usb
+        if usb.stop_event.is_set():
+            return b'\xFF'
+        return usb.read(n)
+
+    def send(self, data):
+        mock_pyb.hardware_ops['USB_VCP.send'] += 1
+        self.emulator.usb.write(data)
+        return len(data)
+
+    write = send
+
+# Byte_pipe -----------------------------------------------------------------------------
+
+class Byte_pipe():
+    '''Connection between the emulated USB_VCP and the host, with the read, any and write
+    interface of Virtual_pyboard.  Bytes for the firmware to read are added with send,
+    bytes written by the firmware are taken with take_output.'''
+
+    def __init__(self):
+        self.input = bytearray()  # Bytes from host not yet read by firmware.
+        self.output = bytearray() # Bytes written by firmware not yet taken.
+        self.stop_event = threading.Event()
+
+    def read(self, n, timeout=None):
+        data = bytes(self.input[:n])
+        del self.input[:n]
+        return data
+
+    def any(self):
+        return len(self.input)
+
+    def write(self, data):
+        self.output += data
+
+    def send(self, data):
+        '''Add bytes for the firmware to read.'''
+        self.input += data
+
+    def take_output(self):
+        '''Return and clear the bytes written by the firmware.'''
+        output = bytes(self.output)
+        self.output.clear()
+        self.stop_event.clear()
+        return output
+
+# Checking output -----------------------------------------------------------------------
+
+def decode_output(output, buffer_size, protocol=1, period=2):
+    '''Decode the bytes sent by the firmware using the checks applied by
+    Acquisition_board.read_serial (protocol 1) and read_serial_v2 (protocol 2).  Returns
+    the data samples and the number of bad and skipped chunks.'''
+    chunks, n_bad, n_skipped = [], 0, 0
+    chunk_numbers = []
+    if protocol == 2:
+        i = 0
+        while len(output) - i >= 10:
+            n_payload = output[i] | (output[i+1] << 8)
+            frame = np.frombuffer(output, dtype=np.uint8, count=n_payload+6, offset=i)
+            checksum = output[i+n_payload+6] | (output[i+n_payload+7] << 8)
+            data = decode_chunk_v2(frame[6:], buffer_size, period)
+            frame_size = (n_payload + 13) & ~3 # Padded to a multiple of 4 bytes.
+            if checksum != int(frame.sum()) & 0xffff or any(output[i+n_payload+8:i+frame_size]) or data is None:
+                n_bad += 1
+                break
+            chunk_numbers.append(output[i+2] | (output[i+3] << 8))
+            chunks.append(data)
+            i += frame_size
+    else:
+        n_chunks = len(output) // ((buffer_size+4)*2)
+        frames = np.frombuffer(output, dtype=np.dtype('<u2'),
+                               count=n_chunks*(buffer_size+4)).reshape(n_chunks, -1)
+        frame_OK = ((frames[:,-2] == frames[:,:-2].sum(axis=1, dtype=np.dtype('<u2'))) &
+                    (frames[:,-1] == 0))
+        n_bad = int(np.sum(~frame_OK))
+        chunks = list(frames[frame_OK,:-4])
+        chunk_numbers = list(frames[frame_OK,-3])
+    if chunk_numbers:
+        n_skipped = int(np.sum((np.diff(np.array(chunk_numbers, dtype=np.int64)) - 1) & 0xffff))
+    data = np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.dtype('<u2'))
+    return data, n_bad, n_skipped
+
+# Command line interface ----------------------------------------------------------------
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the photometry firmware under emulation.')
+    parser.add_argument('--firmware', default='uPy/photometry_upy.py')
+    parser.add_argument('--mode', default=None, help='Acquisition mode, default all modes.')
+    parser.add_argument('--sampling-rate', type=int, default=130, help='Rate passed to start (Hz).')
+    parser.add_argument('--duration', type=float, default=2, help='Virtual time to run (s).')
+    parser.add_argument('--protocol', type=int, default=1)
+    parser.add_argument('--n-buffers', type=int, default=2)
+    parser.add_argument('--oversampling', type=int, default=64)
+    args = parser.parse_args()
+    modes = [args.mode] if args.mode else ['2 colour continuous', '1 colour time div.',
+        '2 colour time div.', '1site-3colors', '1site-4colors', '2sites-3colors', '2sites-4colors']
+    buffer_size = max(2, int(args.sampling_rate//40)*2)
+    for mode in modes:
+        emulator = Firmware_emulator(args.firmware, profile=True)
+        output = emulator.run(mode, args.sampling_rate, buffer_size, args.duration,
+                              args.protocol, args.n_buffers, args.oversampling)
+        period = 4 if '4colors' in mode else 3 if '3colors' in mode else 2
+        data, n_bad, n_skipped = decode_output(output, buffer_size, args.protocol, period)
+        print(f'\n{mode}')
+        print(f'    bytes sent      {len(output):8d} ({len(output)/max(len(data),1):.2f} per sample)')
+        print(f'    samples         {len(data):8d}')
+        print(f'    bad chunks      {n_bad:8d}')
+        print(f'    skipped chunks  {n_skipped:8d}')
+        for name, profile in emulator.ISR_profile().items():
+            print(f'    {name}')
+            for measure, value in profile.items():
+                print(f'        {measure:<16}{value:8.1f}')
@@ -0,0 +1,395 @@
+# Virtual pyboard running on a pseudo terminal, which emulates a pyboard running the
+# photometry firmware so the host code can be run and load tested without hardware.
+# Copyright (c) Thomas Akam 2018-2020.  Licenced under the GNU General Public License v3.
+#
+# Usage from the repository root:
+#     python -m tools.virtual_pyboard [--drop-byte-rate RATE ...]  (see --help)
+# then connect an Acquisition_board to the printed port, or from Python:
+#     board_sim = Virtual_pyboard()
+#     board = Acquisition_board(board_sim.port)
+# With --firmware PATH the board runs the firmware file under emulation (see upy_emulator)
+# instead of the simulated firmware.
+
+import os
+import pty
+import tty
+import time
+import types
+import select
+import argparse
+import builtins
+import tempfile
+import threading
+import traceback
+import numpy as np
+
+from tools.upy_emulator import Firmware_emulator
+
+ADC_volts_per_division = [0.00010122, 0.00010122] # Analog signal volts per division for signal [1, 2]
+
+mode_periods = {'2 colour continuous': 2, '1 colour time div.': 2, '2 colour time div.': 2,
+                '1site-3colors': 3, '2sites-3colors': 3, '1site-4colors': 4, '2sites-4colors': 4}
+
+# Virtual_pyboard -----------------------------------------------------------------------
+
+class Virtual_pyboard(threading.Thread):
+    '''Emulates a pyboard running the photometry firmware, connected to the host through
+    a pseudo terminal whose device path is given by the port attribute.  Implements the
+    raw REPL protocol used by Pyboard and executes the code sent by Acquisition_board,
+    with files read and written in a temporary flash directory.  Importing photometry_upy
+    gives a simulated firmware whose Photometry.start() streams data chunks in the format
+    sent by photometry_upy._send_buffer.  Faults can be injected into the data stream by
+    setting the following attributes, also while streaming:
+        drop_byte_rate    - Probability that a byte is removed from a chunk.
+        bad_checksum_rate - Probability that a chunk is sent with a wrong checksum.
+        drop_chunk_rate   - Probability that a chunk is not sent.
+        stall_rate        - Probability of stalling for stall_dur seconds before a chunk,
+                            chunks due during the stall are then sent in a burst.  As on
+                            a pyboard, chunks which do not fit in the ring of sample 
+                            buffers are lost and counted as overruns.
+    If firmware_path is specified importing photometry_upy instead gives the firmware
+    file run in real time by a Firmware_emulator, and faults are not injected.
+    '''
+
+    def __init__(self, drop_byte_rate=0, bad_checksum_rate=0, drop_chunk_rate=0,
+                 stall_rate=0, stall_dur=0.5, seed=None, firmware_path=None):
+        super().__init__(daemon=True)
+        self.firmware_path = firmware_path
+        self.drop_byte_rate = drop_byte_rate
+        self.bad_checksum_rate = bad_checksum_rate
+        self.drop_chunk_rate = drop_chunk_rate
+        self.stall_rate = stall_rate
+        self.stall_dur = stall_dur
+        self.random = np.random.default_rng(seed)
+        self.master_fd, self.slave_fd = pty.openpty()
+        tty.setraw(self.slave_fd)
+        os.set_blocking(self.master_fd, False)
+        self.port = os.ttyname(self.slave_fd)
+        self.flash_dir = tempfile.mkdtemp(prefix='virtual_pyboard_')
+        self.input = bytearray() # Bytes received from host not yet read.
+        self.input_condition = threading.Condition()
+        self.stop_event = threading.Event()
+        self.raw_repl = False
+        self.soft_reset()
+        self.io_thread = threading.Thread(target=self._io_loop, daemon=True)
+        self.io_thread.start()
+        self.start()
+
+    def stop(self):
+        '''Stop the virtual pyboard and close the pseudo terminal.'''
+        self.stop_event.set()
+        self.join()
+        self.io_thread.join()
+        os.close(self.master_fd)
+        os.close(self.slave_fd)
+
+    def soft_reset(self):
+        '''Clear the namespace code is executed in, as a soft reset does on a pyboard.'''
+        self.pyb = types.SimpleNamespace(USB_VCP=lambda: Virtual_USB_VCP(self),
+                                         udelay=lambda us: time.sleep(us/1e6),
+                                         delay=lambda ms: time.sleep(ms/1e3))
+        self.namespace = {'pyb': self.pyb}
+        self.emulator = None
+
+    # Serial IO ----------------------------------------------------------------
+
+    def _io_loop(self):
+        # Move bytes sent by the host into the input buffer.
+        while not self.stop_event.is_set():
+            if select.select([self.master_fd], [], [], 0.05)[0]:
+                try:
+                    data = os.read(self.master_fd, 4096)
+                except OSError:
+                    continue
+                with self.input_condition:
+                    self.input += data
+                    self.input_condition.notify_all()
+
+    def read(self, n, timeout=None):
+        '''Read up to n bytes sent by the host, waiting up to timeout seconds for the first
+        byte to arrive, and until n bytes arrive if timeout is None.'''
+        with self.input_condition:
+            if timeout is None:
+                self.input_condition.wait_for(
+                    lambda: len(self.input) >= n or self.stop_event.is_set())
+            else:
+                self.input_condition.wait_for(lambda: self.input, timeout)
+            data = bytes(self.input[:n])
+            del self.input[:n]
+        return data
+
+    def any(self):
+        '''Number of bytes sent by the host waiting to be read.'''
+        return len(self.input)
+
+    def write(self, data):
+        '''Send bytes to the host.'''
+        data = memoryview(bytes(data))
+        while data and not self.stop_event.is_set():
+            if select.select([], [self.master_fd], [], 0.05)[1]:
+                try:
+                    data = data[os.write(self.master_fd, data):]
+                except BlockingIOError:
+                    pass
+
+    # Raw REPL -----------------------------------------------------------------
+
+    def run(self):
+        command = bytearray()
+        while not self.stop_event.is_set():
+            byte = self.read(1, timeout=0.05)
+            if not byte:
+                continue
+            if not self.raw_repl:
+                if byte == b'\x01': # ctrl-A: enter raw REPL.
+                    self.raw_repl = True
+                    command = bytearray()
+                    self.write(b'raw REPL; CTRL-B to exit\r\n>')
+            elif byte == b'\x01':
+                command = bytearray()
+                self.write(b'raw REPL; CTRL-B to exit\r\n>')
+            elif byte == b'\x02': # ctrl-B: exit raw REPL.
+                self.raw_repl = False
+                self.write(b'\r\nMicroPython (virtual pyboard)\r\n>>> ')
+            elif byte == b'\x03': # ctrl-C: clear command.
+                command = bytearray()
+            elif byte == b'\x04': # ctrl-D: execute command, or soft reset if empty.
+                if command:
+                    self.write(b'OK')
+                    output, error = self.exec(command.decode())
+                    self.write(output + b'\x04' + error + b'\x04>')
+                else:
+                    self.soft_reset()
+                    self.write(b'OK\r\nMPY: soft reboot\r\nraw REPL; CTRL-B to exit\r\n>')
+                command = bytearray()
+            else:
+                command += byte
+
+    def exec(self, command):
+        '''Execute command in the board namespace, return printed output and error text.'''
+        output = []
+        def _print(*args, sep=' ', end='\n', **kwargs):
+            output.append(sep.join(str(arg) for arg in args) + end)
+        self.namespace['__builtins__'] = dict(vars(builtins), print=_print,
+                                              open=self._open, __import__=self._import)
+        try:
+            exec(command, self.namespace)
+            error = ''
+        except Exception:
+            error = traceback.format_exc()
+        return (''.join(output).replace('\n', '\r\n').encode(),
+                error.replace('\n', '\r\n').encode())
+
+    def _open(self, file_path, mode='r', *args, **kwargs):
+        # Open files in the flash directory.
+        return open(os.path.join(self.flash_dir, file_path), mode, *args, **kwargs)
+
+    def _import(self, name, *args, **kwargs):
+        if name == 'photometry_upy' and self.firmware_path:
+            if not self.emulator:
+                self.emulator = Firmware_emulator(self.firmware_path, realtime=True, usb=self)
+            return self.emulator.firmware
+        elif name == 'photometry_upy':
+            return types.SimpleNamespace(Photometry=lambda: Simulated_photometry(self))
+        elif name == 'pyb':
+            return self.pyb
+        return builtins.__import__(name, *args, **kwargs)
+
+    # Data streaming -----------------------------------------------------------
+
+    def send_chunk(self, data, chunk_number, overruns=0, protocol=1, period=2):
+        '''Send a chunk of data in the format used by photometry_upy._send_buffer, or
+        _send_buffer_v2 if protocol is 2, with any injected faults.'''
+        if self.random.random() < self.drop_chunk_rate:
+            return
+        if protocol == 2:
+            payload = encode_chunk_v2(data, period)
+            chunk = np.zeros((len(payload)+13) & ~3, dtype=np.uint8) # Padded to a multiple of 4 bytes.
+            chunk[:6] = np.array([len(payload), chunk_number, overruns], dtype=np.dtype('<u2')).view(np.uint8)
+            n = len(payload) + 6
+            chunk[6:n] = payload
+            chunk[n:n+2] = np.array([int(chunk[:n].sum()) & 0xffff], dtype=np.dtype('<u2')).view(np.uint8) # Checksum
+            if self.random.random() < self.bad_checksum_rate:
+                chunk[n:n+2] ^= 0x55
+        else:
+            chunk = np.zeros(len(data)+4, dtype=np.dtype('<u2'))
+            chunk[:-4] = data
+            chunk[-4] = overruns
+            chunk[-3] = chunk_number
+            chunk[-2] = chunk[:-2].sum(dtype=np.dtype('<u2')) # Checksum
+            if self.random.random() < self.bad_checksum_rate:
+                chunk[-2] ^= 0x5555
+        chunk_bytes = chunk.tobytes()
+        if self.random.random() < self.drop_byte_rate:
+            i = self.random.integers(len(chunk_bytes))
+            chunk_bytes = chunk_bytes[:i] + chunk_bytes[i+1:]
+        self.write(chunk_bytes)
+
+# Virtual_USB_VCP -----------------------------------------------------------------------
+
+class Virtual_USB_VCP():
+    '''Subset of the pyb.USB_VCP interface used by code executed on the board.'''
+
+    def __init__(self, board_sim):
+        self.board_sim = board_sim
+
+    def setinterrupt(self, char):
+        pass
+
+    def any(self):
+        return self.board_sim.any() > 0
+
+    def read(self, n):
+        return self.board_sim.read(n)
+
+    def recv(self, buf, timeout=5000):
+        # Read bytes into buf until it is full or no byte arrives for timeout ms.
+        n = 0
+        while n < len(buf):
+            data = self.board_sim.read(len(buf)-n, timeout=timeout/1000)
+            if not data:
+                break
+            buf[n:n+len(data)] = data
+            n += len(data)
+        return n
+
+    def write(self, data):
+        self.board_sim.write(data)
+        return len(data)
+
+    send = write
+
+# Simulated_photometry ------------------------------------------------------------------
+
+class Simulated_photometry():
+    '''Simulated version of photometry_upy.Photometry which generates synthetic signals.
+    Each analog channel is a baseline proportional to LED current with a slow oscillation
+    and noise, digital input 1 pulses once per second and digital input 2 every 1.5s.'''
+
+    protocol_versions = (1, 2)
+
+    def __init__(self, board_sim):
+        self.board_sim = board_sim
+        self.volts_per_division = ADC_volts_per_division
+        self.mode = '2 colour continuous'
+        self.LED_current = [0, 0]
+        self.ambientlightcorrection = False
+        self.oversampling = 64
+
+    def set_mode(self, mode):
+        assert mode in mode_periods, 'Invalid mode.'
+        self.mode = mode
+
+    def set_ambientlightcorrection(self, ambientlightcorrection):
+        self.ambientlightcorrection = ambientlightcorrection
+
+    def set_LED_current(self, LED_1_current=None, LED_2_current=None):
+        if LED_1_current is not None:
+            self.LED_current[0] = LED_1_current
+        if LED_2_current is not None:
+            self.LED_current[1] = LED_2_current
+
+    def stop(self):
+        pass
+
+    def generate_samples(self, first_sample, n_samples, sampling_rate):
+        # Samples are interleaved channels, with the digital inputs in the least significant bit.
+        period = mode_periods[self.mode]
+        k = np.arange(first_sample, first_sample+n_samples)
+        t = k/(2*sampling_rate) # Time of each sample (seconds).
+        channel = k % period
+        LED_current = np.array(self.LED_current)[channel % 2]
+        analog = (200*LED_current*(1 + 0.1*np.sin(2*np.pi*(0.5*t + channel/period)))
+                  + 50*np.sqrt(64/self.oversampling)*self.board_sim.random.standard_normal(n_samples))
+        analog = np.clip(analog, 0, (1 << 15) - 1).astype(np.uint16)
+        digital = np.where(channel % 2, (t % 1.5) < 0.1, (t % 1) < 0.05)
+        return (analog << 1) | digital
+
+    def start(self, sampling_rate, buffer_size, protocol=1, n_buffers=2, oversampling=64):
+        # Stream data to host until stop signal is received, chunks are sent at the rate
+        # they would be filled by the sampling timer on a pyboard.  Noise is scaled by
+        # oversampling as for averaging independent ADC reads.
+        self.oversampling = oversampling
+        board_sim = self.board_sim
+        chunk_interval = buffer_size/(2*sampling_rate) # Seconds.
+        chunk_number = 0
+        first_sample = 0
+        n_ring = 0 # Chunks left to send from ring before chunks lost to overruns.
+        n_lost = 0 # Chunks lost to overruns.
+        next_chunk_time = time.perf_counter()
+        while not board_sim.stop_event.is_set():
+            while board_sim.any():
+                received_byte = board_sim.read(1)
+                if received_byte == b'\xFF': # Stop signal.
+                    return
+                elif received_byte == b'\xFD': # Set LED 1 power.
+                    self.set_LED_current(LED_1_current=int.from_bytes(board_sim.read(1), 'little'))
+                elif received_byte == b'\xFE': # Set LED 2 power.
+                    self.set_LED_current(LED_2_current=int.from_bytes(board_sim.read(1), 'little'))
+            wait_time = next_chunk_time - time.perf_counter()
+            if wait_time > 0:
+                time.sleep(min(wait_time, 0.005))
+                continue
+            if board_sim.random.random() < board_sim.stall_rate:
+                time.sleep(board_sim.stall_dur)
+                n_due = int((time.perf_counter() - next_chunk_time)/chunk_interval) + 1
+                if n_due > n_buffers: # Ring overrun, the ring's chunks are sent then the
+                    n_ring = n_buffers - 1 # chunk being written, after those lost.
+                    n_lost = n_due - n_buffers
+            overruns = 0
+            if n_lost and n_ring == 0:
+                overruns, n_lost = n_lost, 0
+                first_sample += overruns*buffer_size
+                next_chunk_time += overruns*chunk_interval
+            n_ring = max(n_ring - 1, 0)
+            next_chunk_time += chunk_interval
+            chunk_number = (chunk_number + 1) & 0xffff
+            data = self.generate_samples(first_sample, buffer_size, sampling_rate)
+            first_sample += buffer_size
+            board_sim.send_chunk(data, chunk_number, overruns, protocol, mode_periods[self.mode])
+
+# Protocol 2 encoding ------------------------------------------------------------------
+
+def encode_varints(values):
+    '''Encode array of non-negative integers as varints, returning a uint8 array.'''
+    values = np.asarray(values, dtype=np.uint32)
+    n_bytes = 1 + sum((values >= 1 << (7*k)).astype(int) for k in range(1, 5))
+    value_index = np.repeat(np.arange(len(values)), n_bytes)
+    byte_index = np.arange(len(value_index)) - np.repeat(np.cumsum(n_bytes) - n_bytes, n_bytes)
+    out = (values[value_index] >> (7*byte_index).astype(np.uint32)) & 127
+    out[byte_index < n_bytes[value_index] - 1] |= 128
+    return out.astype(np.uint8)
+
+def encode_chunk_v2(data, period):
+    '''Encode chunk of samples as the payload sent by photometry_upy._send_buffer_v2.'''
+    analog = (data >> 1).astype(np.int32)
+    deltas = analog.copy()
+    deltas[period:] -= analog[:-period]
+    values = [((deltas << 1) ^ (deltas >> 31)).astype(np.uint32)] # Zigzag encoding.
+    for lane in range(min(period, len(data))):
+        bits = data[lane::period] & 1
+        changes = np.flatnonzero(np.diff(bits))
+        runs = np.diff(np.append(-1, changes))
+        values.append(np.append((len(changes) << 1) | bits[0], runs))
+    return encode_varints(np.concatenate(values))
+
+# Command line interface ----------------------------------------------------------------
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a virtual pyboard on a pseudo terminal.')
+    parser.add_argument('--drop-byte-rate', type=float, default=0)
+    parser.add_argument('--bad-checksum-rate', type=float, default=0)
+    parser.add_argument('--drop-chunk-rate', type=float, default=0)
+    parser.add_argument('--stall-rate', type=float, default=0)
+    parser.add_argument('--stall-dur', type=float, default=0.5)
+    parser.add_argument('--firmware', default=None, help='Firmware file to run under emulation.')
+    args = parser.parse_args()
+    board_sim = Virtual_pyboard(args.drop_byte_rate, args.bad_checksum_rate,
+                                args.drop_chunk_rate, args.stall_rate, args.stall_dur,
+                                firmware_path=args.firmware)
+    print(f'Virtual pyboard running on port: {board_sim.port}')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        board_sim.stop()
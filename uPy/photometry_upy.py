@@ -28,6 +28,8 @@ ADC_volts_per_division = [0.00010122, 0.00010122] # Analog signal volts per divi
 
 class Photometry():
 
+    protocol_versions = (1, 2) # Serial data formats supported, see _send_buffer and _send_buffer_v2.
+
     def __init__(self):
         self.LED_slope  = LED_calibration['slope']
         self.LED_offset = LED_calibration['offset']
@@ -47,21 +49,51 @@ class Photometry():
         self.CoolLED22 = Pin('A7', Pin.OUT) # 405nm, port A, CoolLED - site 2
         self.CoolLED23 = Pin('A6', Pin.OUT) # 550nm, port C, CoolLED - site 2
         self.ovs_buffer = array('H',[0]*64) # Oversampling buffer
+        self.ovs_shift = 3                  # Right shift scaling sum of oversampling buffer to 15 bits.
         self.ovs_timer = pyb.Timer(2)       # Oversampling timer
         self.sampling_timer = pyb.Timer(3)
         self.usb_serial = pyb.USB_VCP()
+        self.LED_values = array('H', [0, 0]) # DAC values for LEDs 1 and 2.
         self.running = False
-        self.idx = 1
+        self.step = 0 # Step of time division cycle.
 
     def set_mode(self, mode):
         # Set the acquisition mode.
         assert mode in ['2 colour continuous', '1 colour time div.', '2 colour time div.', '1site-3colors', '1site-4colors', '2sites-3colors', '2sites-4colors'], 'Invalid mode.'
         self.mode = mode
+        if mode in ('1site-4colors', '2sites-4colors'):
+            self.period = 4 # Number of samples per time division cycle.
+        elif mode in ('1site-3colors', '2sites-3colors'):
+            self.period = 3
+        else:
+            self.period = 2
         if mode == '2 colour continuous':
             self.oversampling_rate = 3e5   # Hz.
         else:
             self.oversampling_rate = 256e3 # Hz.
         self.one_color = True if mode == '1 colour time div.' else False
+        self._make_step_table()
+
+    def _make_step_table(self):
+        # Make table of (ADC, LED pin, DAC, LED index, DAC off, digital input) for each step of
+        # the time division cycle, used by time_div_ISR.  At each step the LED pin is switched
+        # on, and if DAC is not None the DAC is set to the value of LED LED_index, while the 
+        # baseline is read from ADC.  After the sample is read the LED pin is switched off,
+        # and the DAC is set to 0 if DAC_off, and the digital input is read.
+        if self.mode in ('1site-3colors', '1site-4colors'):
+            step_table = [(self.ADC1, self.CoolLED11, self.LED1, 0, False, self.DI1),  # calcium green
+                          (self.ADC2, self.CoolLED13, self.LED2, 1, False, self.DI2),  # calcium red
+                          (self.ADC1, self.CoolLED12, None, 0, False, self.DI1),       # isosbestic green
+                          (self.ADC2, self.CoolLED11, None, 0, False, self.DI2)]       # isosbestic red
+        elif self.mode in ('2sites-3colors', '2sites-4colors'):
+            step_table = [(self.ADC1, self.CoolLED11, None, 0, False, self.DI1),  # calcium green, site 1
+                          (self.ADC4, self.CoolLED23, None, 0, False, self.DI2),  # calcium red, site 2
+                          (self.ADC1, self.CoolLED12, None, 0, False, self.DI1),  # isosbestic green, site 1
+                          (self.ADC4, self.CoolLED21, None, 0, False, self.DI2)]  # isosbestic red, site 2
+        else: # Alternating LED 1 and LED 2 illumination.
+            step_table = [(self.ADC1, self.CoolLED11, self.LED1, 0, True, self.DI1),
+                          (self.ADC1 if self.one_color else self.ADC2, self.CoolLED12, self.LED2, 1, True, self.DI2)]
+        self.step_table = tuple(step_table[:self.period])
 
     def set_ambientlightcorrection(self, ambientlightcorrection):
         self.ambientlightcorrection = ambientlightcorrection
@@ -80,6 +112,7 @@ class Photometry():
             else:
                 self.LED_1_value = int(self.LED_slope*LED_1_current+self.LED_offset)
                 self.CoolLED11.value(1)
+            self.LED_values[0] = self.LED_1_value
             if self.running and (self.mode == '2 colour continuous'):
                 self.LED1.write(self.LED_1_value)
         if LED_2_current is not None:
@@ -94,25 +127,47 @@ class Photometry():
             else:
                 self.LED_2_value = int(self.LED_slope*LED_2_current+self.LED_offset)
                 self.CoolLED12.value(1)
+            self.LED_values[1] = self.LED_2_value
             if self.running and (self.mode == '2 colour continuous'):
                 self.LED2.write(self.LED_2_value)
 
-    def start(self, sampling_rate, buffer_size):
+    def start(self, sampling_rate, buffer_size, protocol=1, n_buffers=2, oversampling=64):
         # Start acquisition, stream data to computer, wait for ctrl+c over serial to stop. 
-        # Setup sample buffers.
-        self.idx = 1
+        # protocol specifies the format data is sent in, 1: 16 bit samples, 2: compact.
+        # Samples are written to a ring of up to n_buffers sample buffers, limited to half
+        # the free memory, so data is not lost if sending is held up for a few buffers.
+        # oversampling is the number of ADC reads averaged per sample, 8, 16, 32 or 64,
+        # fewer reads shorten the ISRs allowing higher sampling rates with more noise.
+        assert oversampling in (8, 16, 32, 64), 'Invalid oversampling.'
+        self.ovs_buffer = array('H',[0]*oversampling)
+        self.ovs_shift = {8: 0, 16: 1, 32: 2, 64: 3}[oversampling]
+        self.step = 0
         self.buffer_size = buffer_size
-        self.sample_buffers = (array('H',[0]*(buffer_size+3)), array('H',[0]*(buffer_size+3)))
-        self.buffer_data_mv = (memoryview(self.sample_buffers[0])[:-3], 
-                               memoryview(self.sample_buffers[1])[:-3])    
+        self.chunk_number = 0 # Number of data chunks sent to computer, modulo 2**16.
+        self.sample_buffers = None
+        self.buffer_data_mv = None
+        if protocol == 2:
+            self.send_buffer = self._send_buffer_v2
+            frame_size = (6*buffer_size + 3*self.period + 13) & ~3 # Max encoded chunk size, padded to multiple of 4 bytes.
+            self.frame_buffer = bytearray(frame_size)
+            frame_buffer_mv = memoryview(self.frame_buffer)
+            # Views of the first 4*i bytes of the frame buffer, so sending does not allocate.
+            self.frame_views = tuple(frame_buffer_mv[:n] for n in range(0, frame_size+1, 4))
+        else:
+            self.send_buffer = self._send_buffer
+        # Setup sample buffers.
+        gc.collect()
+        self.n_buffers = max(2, min(n_buffers, gc.mem_free() // (2*(2*buffer_size+16))))
+        self.sample_buffers = tuple(array('H',[0]*(buffer_size+4)) for i in range(self.n_buffers))
+        self.buffer_data_mv = tuple(memoryview(buf)[:-4] for buf in self.sample_buffers)
         self.sample = 0
         self.baseline = 0
         self.dig_sample = False
         self.write_buf = 0 # Buffer to write data to.
-        self.send_buf  = 1 # Buffer to send data from.
+        self.send_buf  = 0 # Buffer to send data from.
         self.write_ind = 0 # Buffer index to write new data to. 
-        self.buffer_ready = False # Set to True when full buffer is ready to send.
-        self.chunk_number = 0 # Number of data chunks sent to computer, modulo 2**16.
+        self.n_ready = 0   # Number of full buffers ready to send.
+        self.overruns = 0  # Number of full buffers overwritten because ring was full.
         self.running = True
         self.ovs_timer.init(freq=self.oversampling_rate)
         self.usb_serial.setinterrupt(-1) # Disable serial interrupt.
@@ -127,8 +182,8 @@ class Photometry():
             self.sampling_timer.init(freq=sampling_rate*2)
             self.sampling_timer.callback(self.time_div_ISR)
         while True:
-            if self.buffer_ready:
-                self._send_buffer()
+            if self.n_ready:
+                self.send_buffer()
             if self.usb_serial.any():
                 self.recieved_byte = self.usb_serial.read(1)
                 if self.recieved_byte == b'\xFF': # Stop signal.
@@ -153,7 +208,7 @@ class Photometry():
         self.CoolLED21.value(0)
         self.CoolLED22.value(0)
         self.CoolLED23.value(0)
-        self.idx = 1
+        self.step = 0
         self.running = False
         self.usb_serial.setinterrupt(3) # Enable serial interrupt.
         gc.enable()
@@ -162,193 +217,163 @@ class Photometry():
     def cont_2_col_ISR(self, t):
         # Interrupt service routine for 2 color continuous acquisition mode.
         self.ADC1.read_timed(self.ovs_buffer, self.ovs_timer) # Read sample of analog 1.
-        self.sample = sum(self.ovs_buffer) >> 3
+        self.sample = sum(self.ovs_buffer) >> self.ovs_shift
         self.sample_buffers[self.write_buf][self.write_ind] = (self.sample << 1) | self.DI1.value()
         self.write_ind += 1
         self.ADC2.read_timed(self.ovs_buffer, self.ovs_timer) # Read sample of analog 2.
-        self.sample = sum(self.ovs_buffer) >> 3
+        self.sample = sum(self.ovs_buffer) >> self.ovs_shift
         self.sample_buffers[self.write_buf][self.write_ind] = (self.sample << 1) | self.DI2.value()
-        # Update write index and switch buffers if full.
+        # Update write index and move to next buffer in ring if full.
         self.write_ind = (self.write_ind + 1) % self.buffer_size
-        if self.write_ind == 0: # Buffer full, switch buffers.
-            self.write_buf = 1 - self.write_buf
-            self.send_buf  = 1 - self.send_buf
-            self.buffer_ready = True
+        if self.write_ind == 0:
+            self._next_buffer()
 
     @micropython.native
     def time_div_ISR(self, t):
         # Interrupt service routine for time division + baseline subtraction acquisition 
-        # modes. 
-        if self.mode == '1site-3colors':
-            if self.idx == 1:   			# calcium green
-                self.ADC1.read_timed(self.ovs_buffer, self.ovs_timer)
-                self.LED1.write(self.LED_1_value)
-                self.CoolLED11.value(1)
-            elif self.idx == 2:   			# calcium red
-                self.ADC2.read_timed(self.ovs_buffer, self.ovs_timer)
-                self.LED2.write(self.LED_2_value)
-                self.CoolLED13.value(1)
-            elif self.idx == 3:             # isosbestic green
-                self.ADC1.read_timed(self.ovs_buffer, self.ovs_timer)
-                self.CoolLED12.value(1)
-        elif self.mode == '1site-4colors':
-            if self.idx == 1:   			# calcium green
-                self.ADC1.read_timed(self.ovs_buffer, self.ovs_timer)
-                self.LED1.write(self.LED_1_value)
-                self.CoolLED11.value(1)
-            elif self.idx == 2:   			# calcium red
-                self.ADC2.read_timed(self.ovs_buffer, self.ovs_timer)
-                self.LED2.write(self.LED_2_value)
-                self.CoolLED13.value(1)
-            elif self.idx == 3:             # isosbestic green
-                self.ADC1.read_timed(self.ovs_buffer, self.ovs_timer)
-                self.CoolLED12.value(1)
-            elif self.idx == 4:   			# isosbestic red
-                self.ADC2.read_timed(self.ovs_buffer, self.ovs_timer)
-                self.CoolLED11.value(1)
-        elif self.mode == '2sites-3colors':
-            if self.idx == 1:   			# calcium green, site 1
-                self.ADC1.read_timed(self.ovs_buffer, self.ovs_timer)
-                self.CoolLED11.value(1)
-            elif self.idx == 2:   			# calcium red, site 2
-                self.ADC4.read_timed(self.ovs_buffer, self.ovs_timer)
-                self.CoolLED23.value(1)
-            elif self.idx == 3:             # isosbestic green, site 1
-                self.ADC1.read_timed(self.ovs_buffer, self.ovs_timer)
-                self.CoolLED12.value(1)
-        elif self.mode == '2sites-4colors':
-            if self.idx == 1:   			# calcium green, site 1
-                self.ADC1.read_timed(self.ovs_buffer, self.ovs_timer)
-                self.CoolLED11.value(1)
-            elif self.idx == 2:   			# calcium red, site 2
-                self.ADC4.read_timed(self.ovs_buffer, self.ovs_timer)
-                self.CoolLED23.value(1)
-            elif self.idx == 3:             # isosbestic green, site 1
-                self.ADC1.read_timed(self.ovs_buffer, self.ovs_timer)
-                self.CoolLED12.value(1)
-            elif self.idx == 4:   			# isosbestic red, site 2
-                self.ADC4.read_timed(self.ovs_buffer, self.ovs_timer)
-                self.CoolLED21.value(1)
-        else:
-            if self.write_ind % 2:   # Odd samples are LED 2 illumination.
-                if self.one_color:   # Same analog input read for LEDs 1 and 2.
-                    self.ADC1.read_timed(self.ovs_buffer, self.ovs_timer)
-                else:                # Different analog inputs read for LEDs 1 and 2.
-                    self.ADC2.read_timed(self.ovs_buffer, self.ovs_timer)
-                self.LED2.write(self.LED_2_value)
-                self.CoolLED12.value(1)
-            else:                    # Even samples are LED 1 illumination.
-                self.ADC1.read_timed(self.ovs_buffer, self.ovs_timer)
-                self.LED1.write(self.LED_1_value)
-                self.CoolLED11.value(1)
-        self.baseline = sum(self.ovs_buffer) >> 3            
+        # modes.  The ADC, LEDs and digital input used at each step of the time division
+        # cycle are looked up in the step table made by _make_step_table.
+        ADC, LED_pin, DAC, LED_index, DAC_off, DI = self.step_table[self.step]
+        ADC.read_timed(self.ovs_buffer, self.ovs_timer) # Read baseline.
+        if DAC is not None:
+            DAC.write(self.LED_values[LED_index])
+        LED_pin.value(1)
+        self.baseline = sum(self.ovs_buffer) >> self.ovs_shift            
         pyb.udelay(300) # Wait before reading ADC (us).
         # Acquire sample, subtract baseline, store in buffer.
-        if self.mode == '1site-3colors':
-            if self.idx == 1:               # calcium green
-                self.ADC1.read_timed(self.ovs_buffer, self.ovs_timer)
-                self.CoolLED11.value(0)
-                self.dig_sample = self.DI1.value()
-            elif self.idx == 2:             # calcium red
-                self.ADC2.read_timed(self.ovs_buffer, self.ovs_timer)
-                self.CoolLED13.value(0)
-                self.dig_sample = self.DI2.value()
-            elif self.idx == 3:             # isosbestic green
-                self.ADC1.read_timed(self.ovs_buffer, self.ovs_timer)
-                self.CoolLED12.value(0)
-                self.dig_sample = self.DI1.value()  # discarded later
-            self.idx = self.idx + 1
-            if self.idx > 3:
-                self.idx = 1
-        elif self.mode == '1site-4colors':
-            if self.idx == 1:               # calcium green
-                self.ADC1.read_timed(self.ovs_buffer, self.ovs_timer)
-                self.CoolLED11.value(0)
-                self.dig_sample = self.DI1.value()
-            elif self.idx == 2:             # calcium red
-                self.ADC2.read_timed(self.ovs_buffer, self.ovs_timer)
-                self.CoolLED13.value(0)
-                self.dig_sample = self.DI2.value()
-            elif self.idx == 3:             # isosbestic green
-                self.ADC1.read_timed(self.ovs_buffer, self.ovs_timer)
-                self.CoolLED12.value(0)
-                self.dig_sample = self.DI1.value()
-            elif self.idx == 4:             # isosbestic red
-                self.ADC2.read_timed(self.ovs_buffer, self.ovs_timer)
-                self.CoolLED11.value(0)
-                self.dig_sample = self.DI2.value()
-            self.idx = self.idx + 1
-            if self.idx > 4:
-                self.idx = 1
-        elif self.mode == '2sites-3colors':
-            if self.idx == 1:  # calcium green
-                self.ADC1.read_timed(self.ovs_buffer, self.ovs_timer)
-                self.CoolLED11.value(0)
-                self.dig_sample = self.DI1.value()
-            elif self.idx == 2:  # calcium red
-                self.ADC4.read_timed(self.ovs_buffer, self.ovs_timer)
-                self.CoolLED23.value(0)
-                self.dig_sample = self.DI2.value()
-            elif self.idx == 3:  # isosbestic green
-                self.ADC1.read_timed(self.ovs_buffer, self.ovs_timer)
-                self.CoolLED12.value(0)
-                self.dig_sample = self.DI1.value() # discarded later
-            self.idx = self.idx + 1
-            if self.idx > 3:
-                self.idx = 1
-        elif self.mode == '2sites-4colors':
-            if self.idx == 1:               # calcium green
-                self.ADC1.read_timed(self.ovs_buffer, self.ovs_timer)
-                self.CoolLED11.value(0)
-                self.dig_sample = self.DI1.value()
-            elif self.idx == 2:             # calcium red
-                self.ADC4.read_timed(self.ovs_buffer, self.ovs_timer)
-                self.CoolLED23.value(0)
-                self.dig_sample = self.DI2.value()
-            elif self.idx == 3:             # isosbestic green
-                self.ADC1.read_timed(self.ovs_buffer, self.ovs_timer)
-                self.CoolLED12.value(0)
-                self.dig_sample = self.DI1.value()
-            elif self.idx == 4:             # isosbestic red
-                self.ADC4.read_timed(self.ovs_buffer, self.ovs_timer)
-                self.CoolLED21.value(0)
-                self.dig_sample = self.DI2.value()
-            self.idx = self.idx + 1
-            if self.idx > 4:
-                self.idx = 1
-        else:
-            if self.write_ind % 2:
-                if self.one_color:
-                    self.ADC1.read_timed(self.ovs_buffer, self.ovs_timer)
-                else:
-                    self.ADC2.read_timed(self.ovs_buffer, self.ovs_timer)
-                self.LED2.write(0)
-                self.CoolLED12.value(0)
-                self.dig_sample = self.DI2.value()
-            else:
-                self.ADC1.read_timed(self.ovs_buffer, self.ovs_timer)
-                self.LED1.write(0)
-                self.CoolLED11.value(0)
-                self.dig_sample = self.DI1.value()
-        self.sample = sum(self.ovs_buffer) >> 3
+        ADC.read_timed(self.ovs_buffer, self.ovs_timer)
+        if DAC_off:
+            DAC.write(0)
+        LED_pin.value(0)
+        self.dig_sample = DI.value()
+        self.step += 1
+        if self.step == self.period:
+            self.step = 0
+        self.sample = sum(self.ovs_buffer) >> self.ovs_shift
         if self.ambientlightcorrection == True:
             self.sample = max(self.sample - self.baseline, 0)
         else:
             self.sample = max(self.sample, 0)
         self.sample_buffers[self.write_buf][self.write_ind] = (self.sample << 1) | self.dig_sample
-        # Update write index and switch buffers if full.
+        # Update write index and move to next buffer in ring if full.
         self.write_ind = (self.write_ind + 1) % self.buffer_size
-        if self.write_ind == 0: # Buffer full, switch buffers.
-            self.write_buf = 1 - self.write_buf
-            self.send_buf  = 1 - self.send_buf
-            self.buffer_ready = True
+        if self.write_ind == 0:
+            self._next_buffer()
+
+    @micropython.native
+    def _next_buffer(self):
+        # Called by ISRs when the buffer being written is full.  Move to the next buffer
+        # in the ring if one is free, otherwise overwrite the current buffer and count the
+        # overrun in its trailer so the host knows a buffer of data is missing before it.
+        if self.n_ready < self.n_buffers - 1:
+            self.write_buf = (self.write_buf + 1) % self.n_buffers
+            self.sample_buffers[self.write_buf][-4] = 0
+            self.n_ready += 1
+        else:
+            self.sample_buffers[self.write_buf][-4] += 1
+            self.overruns += 1
+
+    @micropython.native
+    def _sent_buffer(self):
+        # Release the buffer which has been sent.
+        self.send_buf = (self.send_buf + 1) % self.n_buffers
+        irq_state = pyb.disable_irq()
+        self.n_ready -= 1
+        pyb.enable_irq(irq_state)
 
     @micropython.native
     def _send_buffer(self):
         # Send full buffer to host computer. Format of serial chunks sent to the computer: 
-        # buffer[:-3] = data, buffer[-3] = chunk number, buffer[-2] = checksum, buffer[-1] = 0.
+        # buffer[:-4] = data, buffer[-4] = number of buffers lost to overruns before this 
+        # one, buffer[-3] = chunk number, buffer[-2] = checksum of buffer[:-2], buffer[-1] = 0.
         self.chunk_number = (self.chunk_number + 1) & 0xffff
-        self.sample_buffers[self.send_buf][-3] = self.chunk_number
-        self.sample_buffers[self.send_buf][-2] = sum(self.buffer_data_mv[self.send_buf]) & 0xffff # Checksum
-        self.usb_serial.send(self.sample_buffers[self.send_buf])
-        self.buffer_ready = False
\ No newline at end of file
+        buf = self.sample_buffers[self.send_buf]
+        buf[-3] = self.chunk_number
+        buf[-2] = (sum(self.buffer_data_mv[self.send_buf]) + buf[-4] + buf[-3]) & 0xffff # Checksum
+        self.usb_serial.send(buf)
+        self._sent_buffer()
+
+    @micropython.native
+    def _send_buffer_v2(self):
+        # Send full buffer to host computer in compact format.  Format of serial chunks:
+        # [payload length (2 bytes), chunk number (2 bytes), overruns (2 bytes), payload, 
+        # checksum (2 bytes), 0 (2 bytes), 0 to 3 zero bytes padding the chunk to a multiple
+        # of 4 bytes], where overruns is the number of buffers lost before this one (see
+        # _send_buffer) and checksum is the sum of the header and payload bytes, modulo
+        # 2**16.  Padding allows chunks to be sent from preallocated views of the frame
+        # buffer, so sending does not allocate memory.  The payload is a sequence of varints
+        # (7 bits per byte, least significant first, high bit set on all but the last
+        # byte).  The first buffer_size varints are the analog samples, each encoded as the
+        # zigzag encoded difference from the sample one time division period earlier.  The 
+        # digital inputs are then run length encoded for each of the period lanes (samples
+        # lane, lane+period, ...): (n_changes << 1 | first value) followed by the lengths of 
+        # the runs before each change.
+        self.chunk_number = (self.chunk_number + 1) & 0xffff
+        data = self.buffer_data_mv[self.send_buf]
+        out = self.frame_buffer
+        period = self.period
+        checksum = 0
+        n = 6
+        for i in range(self.buffer_size):
+            if i < period:
+                d = data[i] >> 1
+            else:
+                d = (data[i] >> 1) - (data[i-period] >> 1)
+            z = d << 1 if d >= 0 else ((-d) << 1) - 1
+            while z > 127:
+                out[n] = (z & 127) | 128
+                checksum += out[n]
+                z >>= 7
+                n += 1
+            out[n] = z
+            checksum += z
+            n += 1
+        self.checksum = checksum # Updated by _write_varint.
+        for lane in range(min(period, self.buffer_size)):
+            value = data[lane] & 1
+            n_changes = 0
+            for i in range(lane+period, self.buffer_size, period):
+                if data[i] & 1 != value:
+                    n_changes += 1
+                    value ^= 1
+            n = self._write_varint(n, (n_changes << 1) | (data[lane] & 1))
+            value = data[lane] & 1
+            run = 1
+            for i in range(lane+period, self.buffer_size, period):
+                if data[i] & 1 != value:
+                    n = self._write_varint(n, run)
+                    value ^= 1
+                    run = 1
+                else:
+                    run += 1
+        n_payload = n - 6
+        overruns = self.sample_buffers[self.send_buf][-4]
+        out[0] = n_payload & 0xff
+        out[1] = n_payload >> 8
+        out[2] = self.chunk_number & 0xff
+        out[3] = self.chunk_number >> 8
+        out[4] = overruns & 0xff
+        out[5] = overruns >> 8
+        checksum = (self.checksum + out[0] + out[1] + out[2] + out[3] + out[4] + out[5]) & 0xffff
+        out[n]   = checksum & 0xff
+        out[n+1] = checksum >> 8
+        out[n+2] = 0
+        out[n+3] = 0
+        n += 4
+        while n & 3: # Padding.
+            out[n] = 0
+            n += 1
+        self.usb_serial.send(self.frame_views[n >> 2])
+        self._sent_buffer()
+
+    @micropython.native
+    def _write_varint(self, n, value):
+        # Write value to frame buffer at index n as a varint, return index after varint.
+        while value > 127:
+            self.frame_buffer[n] = (value & 127) | 128
+            self.checksum += (value & 127) | 128
+            value >>= 7
+            n += 1
+        self.frame_buffer[n] = value
+        self.checksum += value
+        return n + 1